@@ -2,12 +2,18 @@
 # This will replace backend/app.py after reorganization
 # Copy this to backend/app.py after running reorganize_safe.py
 
-from flask import Flask, send_from_directory, jsonify
-from flask_pymongo import PyMongo
+from flask import Flask, Response, abort, send_file, stream_with_context
 from flask_cors import CORS
+from whitenoise import WhiteNoise
 import click
+import json
+import atexit
+import logging
+import logging.handlers
+import queue
 import sys
 import os
+import re
 from pathlib import Path
 
 # If this module is executed directly (python backend/app.py), the
@@ -21,15 +27,65 @@ if __package__ is None:
         sys.path.insert(0, project_root)
 
 from backend.config import Config
+from backend.models import (
+    get_collection, ensure_indexes, backfill_eod_employees_worked, bump_gallery_version
+)
+from backend.services.face_service import descriptor_fields
+from backend.utils import OrjsonProvider
+
+# Assets named like app.3f2a9c1d.js carry a content hash, so they can be
+# cached forever ("immutable"); everything else gets STATIC_MAX_AGE.
+_FINGERPRINT_RE = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+
+def _is_fingerprinted(path, url):
+    return bool(_FINGERPRINT_RE.search(url))
+
+
+def _log_in_background():
+    """
+    Route root log records through a queue so handler I/O (stderr, files)
+    happens on a listener thread instead of the request thread.
+    """
+    root = logging.getLogger()
+    if not root.handlers or any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
 
-mongo = PyMongo()
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.json = OrjsonProvider(app)
+    # No-op if the server (e.g. gunicorn) already configured logging
+    logging.basicConfig(level=app.config["LOG_LEVEL"])
+    _log_in_background()
     CORS(app)
 
-    mongo.init_app(app)
+    # Project root path
+    project_root = Path(__file__).resolve().parent.parent
+    frontend_pages = project_root / "frontend" / "pages"
+    frontend_static = project_root / "frontend" / "static"
+
+    # Serve /static/* straight from the WSGI layer so asset hits never reach
+    # Flask; WhiteNoise hands files to wsgi.file_wrapper (sendfile) when the
+    # server provides it and picks up pre-compressed .gz/.br siblings.
+    app.wsgi_app = WhiteNoise(
+        app.wsgi_app,
+        root=str(frontend_static),
+        prefix="static/",
+        autorefresh=False,
+        max_age=app.config["STATIC_MAX_AGE"],
+        immutable_file_test=_is_fingerprinted,
+    )
+
+    if app.config["ENSURE_INDEXES"]:
+        with app.app_context():
+            ensure_indexes()
 
     from backend.routes.employees import bp as employees_bp
     from backend.routes.timeclock import bp as timeclock_bp
@@ -39,6 +95,10 @@ def create_app():
     from backend.routes.face import bp as face_bp
     from backend.routes.inventory_history import bp as inventory_history_bp
 
+    # Match /api/employees and /api/employees/ alike instead of answering
+    # the slashless form with a redirect
+    app.url_map.strict_slashes = False
+
     # Register blueprints - order matters! More specific routes first
     app.register_blueprint(inventory_history_bp, url_prefix="/api/inventory/history")
     app.register_blueprint(employees_bp, url_prefix="/api/employees")
@@ -58,61 +118,51 @@ def create_app():
     if os.getenv("FLASK_ENV") == "development":
         @app.get("/api/debug/routes")
         def debug_routes():
-            routes = []
-            for rule in app.url_map.iter_rules():
-                routes.append({
-                    "endpoint": rule.endpoint,
-                    "methods": list(rule.methods),
-                    "rule": str(rule)
-                })
-            return jsonify({"routes": routes})
-
-    # Project root path
-    project_root = Path(__file__).resolve().parent.parent
-    frontend_pages = project_root / "frontend" / "pages"
-    frontend_static = project_root / "frontend" / "static"
-
-    # Serve index.html from frontend/pages
-    @app.get("/")
-    def serve_index():
-        return send_from_directory(frontend_pages, "index.html")
-
-    # Serve HTML pages from frontend/pages
-    @app.get("/<path:page>.html")
-    def serve_page(page):
-        return send_from_directory(frontend_pages, f"{page}.html")
-
-    # Serve static CSS files
-    @app.get("/static/css/<path:filename>")
-    def serve_css(filename):
-        return send_from_directory(frontend_static / "css", filename)
-
-    # Serve static JS files
-    @app.get("/static/js/<path:filename>")
-    def serve_js(filename):
-        return send_from_directory(frontend_static / "js", filename)
-
-    # Fallback: serve any other files from frontend/pages (for backward compatibility)
-    # Exclude API routes from catch-all
-    @app.get("/<path:path>")
-    def serve_static(path):
-        # Don't interfere with API routes
-        if path.startswith('api/'):
-            from flask import abort
+            # Encode one rule at a time instead of building the whole list
+            def generate():
+                yield '{"routes": ['
+                for i, rule in enumerate(app.url_map.iter_rules()):
+                    if i:
+                        yield ', '
+                    yield json.dumps({
+                        "endpoint": rule.endpoint,
+                        "methods": list(rule.methods),
+                        "rule": str(rule)
+                    })
+                yield ']}'
+            return Response(stream_with_context(generate()), mimetype="application/json")
+
+    # Resolve every file under frontend/pages once at startup; requests are
+    # then a dict lookup, and anything not in the map (including api/...) 404s
+    page_files = {
+        path.relative_to(frontend_pages).as_posix(): str(path)
+        for path in frontend_pages.rglob("*")
+        if path.is_file()
+    }
+    page_files[""] = page_files.get("index.html")
+
+    def send_page(name):
+        filename = page_files.get(name)
+        if filename is None:
             abort(404)
-        # Try frontend/pages first (for any remaining HTML)
-        if path.endswith('.html'):
-            return send_from_directory(frontend_pages, path)
-        # Otherwise, try static folders
-        if path.startswith('static/'):
-            return send_from_directory(frontend_static, path[7:])  # Remove 'static/' prefix
-        # Fallback to frontend/pages
-        return send_from_directory(frontend_pages, path)
+        return send_file(
+            filename,
+            conditional=True,
+            etag=True,
+            max_age=app.config["PAGE_MAX_AGE"],
+        )
+
+    # One endpoint serves index.html and every other file in frontend/pages;
+    # API URLs match their blueprint rules first and never reach it
+    @app.get("/", defaults={"path": ""})
+    @app.get("/<path:path>")
+    def serve_page(path):
+        return send_page(path)
 
     # CLI command to seed default stores
     @app.cli.command("seed-stores")
     def seed_stores_command(): 
-        stores = mongo.db.stores
+        stores = get_collection("stores")
         if stores.count_documents({}) == 0:
             stores.insert_many([
                 {"name": "Lawrence"},
@@ -122,6 +172,36 @@ def create_app():
         else:
             click.echo("Stores already exist; skipping seed")
 
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        ensure_indexes(upgrade=True)
+        click.echo("Ensured indexes on all collections")
+
+    @app.cli.command("backfill-eod-employees")
+    def backfill_eod_employees_command():
+        updated = backfill_eod_employees_worked()
+        click.echo(f"Backfilled employees_worked on {updated} EOD report(s)")
+
+    @app.cli.command("quantize-face-descriptors")
+    def quantize_face_descriptors_command():
+        employees = get_collection("employees")
+        updated = 0
+        for employee in employees.find(
+            {"face_registered": True, "face_descriptors_q8": {"$exists": False}},
+            {"face_descriptors": 1, "face_descriptor": 1},
+        ):
+            descriptors = employee.get("face_descriptors")
+            if not isinstance(descriptors, list):
+                descriptors = [employee["face_descriptor"]] if "face_descriptor" in employee else []
+            employees.update_one(
+                {"_id": employee["_id"]},
+                {"$set": descriptor_fields(descriptors), "$unset": {"face_descriptor": ""}},
+            )
+            updated += 1
+        if updated:
+            bump_gallery_version()
+        click.echo(f"Quantized face descriptors for {updated} employee(s)")
+
     return app
 
 if __name__ == "__main__":
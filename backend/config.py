@@ -13,7 +13,51 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.getenv("SECRET_KEY", "dev-key")
     MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/timetrack')
+
+    # MongoClient connection pool (one client is shared per process)
+    MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 50))
+    MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 5))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2500))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 3000))
+    # Set by Vercel in its serverless functions, where an instance can be
+    # frozen as soon as the response is sent, so no work is left to
+    # background threads
+    SERVERLESS = bool(os.getenv('VERCEL'))
+    # Create missing indexes when each worker starts (opt-in). Deployments
+    # run `flask --app backend.app ensure-indexes` once per deploy instead
+    ENSURE_INDEXES = os.getenv('ENSURE_INDEXES', 'False').lower() == 'true'
+
+    # Cache lifetime (seconds) for files under /static served by WhiteNoise.
+    # Asset filenames are not content-hashed, so keep this modest unless the
+    # deployment fingerprints them.
+    STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', 3600))
+    # Cache lifetime (seconds) for HTML pages; browsers revalidate with
+    # ETag/Last-Modified once it expires and get a 304 if unchanged.
+    PAGE_MAX_AGE = int(os.getenv('PAGE_MAX_AGE', 300))
+    
+    # Root log level; DEBUG enables per-request debug logging (e.g. EOD submissions)
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+    
+    # bcrypt cost factor for new password hashes. Each step doubles the work;
+    # dev/test can use 4 for sub-millisecond hashing. Existing hashes keep
+    # the cost they were created with.
+    BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+    
+    # Seconds a worker reuses its last read of the face gallery version before
+    # checking MongoDB again; faces registered through another worker can take
+    # this long to become matchable here
+    GALLERY_VERSION_TTL = float(os.getenv('GALLERY_VERSION_TTL', 2))
+    
+    # OTP verifications run against YubiCloud at once (per process). Each
+    # one queries every YubiCloud server, so this many pooled keep-alive
+    # connections are kept per server and 5x as many threads; matches the
+    # 32 concurrent logins the stores routes allow
+    YUBICLOUD_CONCURRENCY = int(os.getenv('YUBICLOUD_CONCURRENCY', 32))
     
     # Manager credentials (should be set via environment variables in production)
     MANAGER_USERNAME = os.getenv('MANAGER_USERNAME', 'manager')
-    MANAGER_PASSWORD = os.getenv('MANAGER_PASSWORD', 'mgr123')
\ No newline at end of file
+    MANAGER_PASSWORD = os.getenv('MANAGER_PASSWORD', 'mgr123')
+    # bcrypt hash of the manager password. When set it is used instead of
+    # MANAGER_PASSWORD, so the plaintext need not be in the environment.
+    # Generate with: python -c "import bcrypt; print(bcrypt.hashpw(b'...', bcrypt.gensalt()).decode())"
+    MANAGER_PASSWORD_BCRYPT = os.getenv('MANAGER_PASSWORD_BCRYPT')
\ No newline at end of file
@@ -1,51 +1,205 @@
 # backend/models.py
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+import hashlib
+import hmac
+import logging
+import os
+import re
+import threading
 from flask import current_app
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import ConnectionFailure, PyMongoError
+from pymongo.collation import Collation
+from pymongo.write_concern import WriteConcern
 import bcrypt
+from cachetools import TTLCache
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import Config
 
 # MongoDB uses dynamic collections — no ORM class needed.
 # These helper functions wrap PyMongo for easy use.
 
+logger = logging.getLogger(__name__)
+
+# One MongoClient per process. The client owns the connection pool, so it is
+# created lazily on first use and then reused by every request (and by warm
+# serverless invocations, which keep module state).
+_CLIENT = None
+_DB = None
+_CLIENT_LOCK = threading.Lock()
+
+# Documents fetched per server round trip by the iter_*() listing helpers
+STREAM_BATCH_SIZE = 200
+
+def get_db():
+    """Return the shared database handle, creating the client on first use."""
+    global _CLIENT, _DB
+    if _DB is None:
+        with _CLIENT_LOCK:
+            if _DB is None:
+                config = current_app.config
+                _CLIENT = MongoClient(
+                    config.get('MONGO_URI', 'mongodb://localhost:27017/timetrack'),
+                    maxPoolSize=config.get('MONGO_MAX_POOL_SIZE', 50),
+                    minPoolSize=config.get('MONGO_MIN_POOL_SIZE', 5),
+                    waitQueueTimeoutMS=config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2500),
+                    serverSelectionTimeoutMS=config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 3000),
+                    retryWrites=True,
+                )
+                # Database name comes from the URI path, e.g. .../timetrack
+                _DB = _CLIENT.get_default_database(default='timetrack')
+    return _DB
+
+# High-frequency append collections acknowledge writes from the primary
+# alone without waiting for the journal (w=1, j=False), rather than the
+# server default (majority on MongoDB 5.0+ / Atlas). Stores, employees and
+# EOD totals keep the default write concern.
+_RELAXED_WRITES = WriteConcern(w=1, j=False)
+_RELAXED_WRITE_COLLECTIONS = frozenset({"timeclock", "inventory_history"})
+
+# Collection handles are cheap but not free to build; the database never
+# changes once connected, so each one is created once per process
+_COLLECTIONS = {}
+
 def get_collection(name):
-    """Helper to get a MongoDB collection from current Flask app context."""
-    # Import mongo instance
-    from .app import mongo
-    
-    # Try accessing db property first (Flask-PyMongo's standard way)
-    db = mongo.db
-    if db is not None:
-        return db[name]
-    
-    # If db is None, Flask-PyMongo might not have initialized properly
-    # Get MONGO_URI from config
-    mongo_uri = current_app.config.get('MONGO_URI', 'mongodb://localhost:27017/timetrack')
-    
-    # Try accessing via client attribute (alternative name in some versions)
-    client = None
-    if hasattr(mongo, 'cx') and mongo.cx is not None:
-        client = mongo.cx
-    elif hasattr(mongo, 'client') and mongo.client is not None:
-        client = mongo.client
-    
-    if client is None:
-        # Last resort: create our own MongoClient using the URI from config
-        from pymongo import MongoClient
-        client = MongoClient(mongo_uri)
-    
-    # Extract database name from MONGO_URI
-    parts = mongo_uri.rsplit('/', 1)
-    if len(parts) == 2 and parts[1]:
-        db_name = parts[1].split('?')[0]  # Remove query params
-    else:
-        db_name = 'timetrack'
-    
-    db = client[db_name]
-    return db[name]
+    """Helper to get a MongoDB collection from the shared client."""
+    collection = _COLLECTIONS.get(name)
+    if collection is None:
+        if name in _RELAXED_WRITE_COLLECTIONS:
+            collection = get_db().get_collection(name, write_concern=_RELAXED_WRITES)
+        else:
+            collection = get_db()[name]
+        _COLLECTIONS[name] = collection
+    return collection
+
+# Indexes backing the query shapes used by the routes and helpers below
+# Compare strings ignoring case (but not accents), e.g. employee names
+CASE_INSENSITIVE = Collation(locale="en", strength=2)
+
+_INDEXES = {
+    "inventory": [
+        IndexModel([("store_id", ASCENDING), ("sku", ASCENDING)]),
+    ],
+    "inventory_history": [
+        # One snapshot per store per day; also serves the newest-first listing.
+        # Replaces the earlier non-unique index on the same keys (see
+        # _upgrade_unique_indexes())
+        IndexModel([("store_id", ASCENDING), ("snapshot_date", ASCENDING)], unique=True),
+    ],
+    "eod": [
+        IndexModel([("store_id", ASCENDING), ("report_date", DESCENDING)]),
+    ],
+    "timeclock": [
+        IndexModel([("store_id", ASCENDING), ("clock_in", ASCENDING)]),
+        # Employee history; clock_out also lets open-entry checks be answered
+        # from the keys alone
+        IndexModel([("employee_id", ASCENDING), ("clock_in", DESCENDING), ("clock_out", ASCENDING)]),
+        # Only the open entries (one per clocked-in employee), so the
+        # "already clocked in?" check stays in memory however long the history
+        IndexModel(
+            [("employee_id", ASCENDING), ("clock_in", DESCENDING)],
+            partialFilterExpression={"clock_out": None}
+        ),
+        # At most one open face clock-in per employee and UTC day, so racing
+        # clock-in upserts cannot both insert (the loser gets DuplicateKeyError)
+        IndexModel(
+            [("employee_id", ASCENDING), ("clock_in_day", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"clock_out": None, "clock_in_day": {"$exists": True}}
+        ),
+    ],
+    "employees": [
+        IndexModel([("store_id", ASCENDING)]),
+        # Case-insensitive name lookups; queries must pass the same collation
+        IndexModel([("name", ASCENDING)], collation=CASE_INSENSITIVE),
+        # Face gallery, most recently registered first
+        IndexModel([("face_registered", ASCENDING), ("face_registered_at", DESCENDING)]),
+    ],
+    "stores": [
+        IndexModel([("name", ASCENDING)], unique=True),
+        # Seeded stores have no username, so only enforce uniqueness when set
+        IndexModel([("username", ASCENDING)], unique=True,
+                   partialFilterExpression={"username": {"$type": "string"}}),
+    ],
+}
+
+def _upgrade_unique_indexes(collection, indexes):
+    """
+    Rebuild existing non-unique indexes that _INDEXES now declares unique on
+    the same keys. MongoDB rejects create_indexes for such a pair (index
+    options conflict), so the old index is dropped first. If existing
+    duplicates block the unique build, the non-unique index is restored.
+    """
+    existing = collection.index_information()
+    for model in indexes:
+        spec = model.document
+        if not spec.get("unique"):
+            continue
+        keys = list(spec["key"].items())
+        for index_name, info in existing.items():
+            if info["key"] != keys or info.get("unique"):
+                continue
+            collection.drop_index(index_name)
+            try:
+                collection.create_indexes([model])
+            except PyMongoError as e:
+                logger.warning(
+                    "Could not make index '%s' on '%s' unique, keeping it non-unique; "
+                    "remove the duplicates and run `flask ensure-indexes` again: %s",
+                    index_name, collection.name, e
+                )
+                collection.create_index(keys, name=index_name)
+
+def _missing_indexes(collection, indexes):
+    """
+    The indexes whose key pattern does not exist on the collection yet.
+    Warns about existing non-unique indexes that _INDEXES declares unique,
+    which only `flask ensure-indexes` upgrades.
+    """
+    existing = {tuple(info["key"]): info for info in collection.index_information().values()}
+    missing = []
+    for model in indexes:
+        spec = model.document
+        info = existing.get(tuple(spec["key"].items()))
+        if info is None:
+            missing.append(model)
+        elif spec.get("unique") and not info.get("unique"):
+            logger.warning(
+                "Index %s on '%s' should be unique; run `flask ensure-indexes` to upgrade it",
+                spec["name"], collection.name
+            )
+    return missing
+
+def ensure_indexes(upgrade=False):
+    """
+    Create the indexes in _INDEXES that do not exist yet.
+    With upgrade=True (the ensure-indexes CLI command, never at startup),
+    existing indexes that became unique are rebuilt first; this drops the
+    old index, so it must not run concurrently from several workers.
+    """
+    db = get_db()
+    for name, indexes in _INDEXES.items():
+        try:
+            if upgrade:
+                _upgrade_unique_indexes(db[name], indexes)
+                db[name].create_indexes(indexes)
+                continue
+            missing = _missing_indexes(db[name], indexes)
+            if missing:
+                db[name].create_indexes(missing)
+        except ConnectionFailure as e:
+            logger.warning("Skipping index creation, database unavailable: %s", e)
+            return
+        except PyMongoError as e:
+            # e.g. duplicate store names in existing data; keep serving
+            logger.warning("Could not create indexes on '%s': %s", name, e)
 
 # ---------- STORES ----------
-def get_default_inventory_items():
-    """Returns a list of default inventory items that should be created for each new store"""
-    return [
+# Default inventory items created for each new store (built once at import)
+_DEFAULT_INVENTORY = (
   {"sku": "Samsung", "name": "S 23 FE"},
   {"sku": "Samsung", "name": "S24 FE"},
   {"sku": "Samsung", "name": "Samsung Tab 3"},
@@ -95,23 +249,61 @@ def get_default_inventory_items():
   {"sku": "Generic", "name": "G400"},
   {"sku": "Generic", "name": "HSI"},
   {"sku": "Simcards", "name": "Simcards"},
-]
+)
+
+def get_default_inventory_items():
+    """Returns the default inventory items that should be created for each new store"""
+    return _DEFAULT_INVENTORY
 
 
 def hash_password(password):
-    """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    """Hash a password using bcrypt (cost factor from Config.BCRYPT_ROUNDS)"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(Config.BCRYPT_ROUNDS)).decode('utf-8')
+
+_DUMMY_HASH = None
+
+def _dummy_hash():
+    """bcrypt hash of a throwaway password, checked when there is no stored hash"""
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password("timetrack-dummy").encode('utf-8')
+    return _DUMMY_HASH
+
+# Successful bcrypt checks, so repeat logins from the same client skip the
+# KDF for a minute. Keys are an HMAC (per-process random key) of the password
+# and stored hash: no plaintext is kept, and a password change produces a new
+# hash and therefore a miss. Failures are never cached.
+_VERIFIED_CACHE = TTLCache(maxsize=1024, ttl=60)
+_VERIFIED_CACHE_LOCK = threading.Lock()
+_VERIFIED_CACHE_KEY = os.urandom(32)
 
 def verify_password(password, hashed):
-    """Verify a password against a hash. Handles both hashed and plain text (for backward compatibility)"""
+    """Verify a password against a hash. Handles both hashed and plain text (for backward compatibility)
+
+    A missing hash (unknown user) still pays for one bcrypt check so it takes
+    as long as a wrong password.
+    """
+    if not hashed:
+        bcrypt.checkpw(password.encode('utf-8'), _dummy_hash())
+        return False
     try:
         # Try to verify as bcrypt hash
         if hashed.startswith('$2b$') or hashed.startswith('$2a$'):
-            return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+            password_bytes = password.encode('utf-8')
+            hashed_bytes = hashed.encode('utf-8')
+            cache_key = hmac.new(_VERIFIED_CACHE_KEY, password_bytes + b'\0' + hashed_bytes, hashlib.sha256).digest()
+            with _VERIFIED_CACHE_LOCK:
+                if cache_key in _VERIFIED_CACHE:
+                    return True
+            if not bcrypt.checkpw(password_bytes, hashed_bytes):
+                return False
+            with _VERIFIED_CACHE_LOCK:
+                _VERIFIED_CACHE[cache_key] = True
+            return True
     except:
         pass
     # Fallback: plain text comparison (for backward compatibility with existing stores)
-    return password == hashed
+    return hmac.compare_digest(password.encode('utf-8'), hashed.encode('utf-8'))
 
 def create_store(name, username=None, password=None, total_boxes=0):
     stores = get_collection("stores")
@@ -130,111 +322,181 @@ def create_store(name, username=None, password=None, total_boxes=0):
         "username": username, 
         "password": password_hash, 
         "total_boxes": total_boxes,
-        "yubikey_ids": []  # List of YubiKey public IDs allowed to login
+        "yubikey_ids": [],  # List of YubiKey public IDs allowed to login
+        "yubikey_id_list": []  # Just the IDs from yubikey_ids, for auth checks
     }
     result = stores.insert_one(doc)
+    _invalidate_stores_cache()
     store_id = str(result.inserted_id)
     
-    # Create default inventory items for this store
+    # Create default inventory items for this store in a single round-trip
     inventory = get_collection("inventory")
-    default_items = get_default_inventory_items()
-    for item in default_items:
-        inventory.insert_one({
+    inventory.insert_many([
+        {
             "store_id": name,  # Use store name as store_id
             "sku": item["sku"],
             "name": item["name"],
             "quantity": 0
-        })
+        }
+        for item in _DEFAULT_INVENTORY
+    ], ordered=False)
     
     return store_id
 
 def get_store_by_username(username):
     stores = get_collection("stores")
-    store = stores.find_one({"username": username}, {"_id": 0})
+    # Repeat the unique username index's partial filter so the planner can
+    # always prove the query is covered by it and never falls back to a scan
+    store = stores.find_one({"username": {"$eq": username, "$type": "string"}}, {"_id": 0})
     return store if store else None
 
-def get_stores():
+def get_store_by_name(name, projection=None):
+    """Single store by its unique name (indexed), or None"""
     stores = get_collection("stores")
-    return list(stores.find({}, {"_id": 0}))  # hide _id for cleaner frontend use
+    return stores.find_one({"name": name}, projection or {"_id": 0})
+
+# The store list changes rarely but is read by most pages. Writes in this
+# process clear it; the TTL bounds staleness from writes in other workers.
+_STORES_CACHE = TTLCache(maxsize=1, ttl=30)
+_STORES_CACHE_LOCK = threading.Lock()
+
+def _invalidate_stores_cache():
+    with _STORES_CACHE_LOCK:
+        _STORES_CACHE.clear()
+
+def get_stores():
+    """
+    All stores, without _id or password hashes (never read from the database).
+    The list is shared with the cache, so callers must not mutate it.
+    """
+    with _STORES_CACHE_LOCK:
+        cached = _STORES_CACHE.get("stores")
+    if cached is None:
+        stores = get_collection("stores")
+        cached = list(stores.find({}, {"_id": 0, "password": 0}))  # hide _id for cleaner frontend use
+        with _STORES_CACHE_LOCK:
+            _STORES_CACHE["stores"] = cached
+    return cached
+
+# YubiKey public IDs are 12 modhex characters; a full OTP is 44
+_MODHEX12 = re.compile(r'^[cbdefghijklnrtuv]{12}\Z')
+_MODHEX44 = re.compile(r'^[cbdefghijklnrtuv]{44}\Z')
+
+# YubiCloud validation servers, all queried for redundancy
+_YUBI_SERVERS = (
+    'https://api.yubico.com/wsapi/2.0/verify',
+    'https://api2.yubico.com/wsapi/2.0/verify',
+    'https://api3.yubico.com/wsapi/2.0/verify',
+    'https://api4.yubico.com/wsapi/2.0/verify',
+    'https://api5.yubico.com/wsapi/2.0/verify',
+)
+
+# Pooled HTTPS session and workers for YubiCloud verification, shared across
+# logins so TLS connections are reused and all servers are queried at once.
+# Each verification holds one thread and one connection per server, so
+# YUBICLOUD_CONCURRENCY verifications fan out fully without queueing.
+_YUBI_SESSION = requests.Session()
+_YUBI_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=len(_YUBI_SERVERS),
+    pool_maxsize=Config.YUBICLOUD_CONCURRENCY,
+    max_retries=Retry(total=1, read=0, status=0),  # retry a failed connect once
+))
+_YUBI_POOL = ThreadPoolExecutor(
+    max_workers=len(_YUBI_SERVERS) * Config.YUBICLOUD_CONCURRENCY, thread_name_prefix="yubicloud"
+)
+# (connect, read) seconds; a slow server is abandoned while the others answer
+_YUBI_TIMEOUT = (1, 2)
+# Seconds a verification may take in total, including time queued for a
+# thread; the OTP is treated as invalid once it passes
+_YUBI_DEADLINE = sum(_YUBI_TIMEOUT)
+
+def _yubicloud_accepts(server, otp):
+    """Ask a single YubiCloud server to validate the OTP."""
+    try:
+        response = _YUBI_SESSION.get(server, params={'id': '1', 'otp': otp, 'nonce': 'timetrack'}, timeout=_YUBI_TIMEOUT)
+    except requests.RequestException:
+        return False
+    # Check if OTP is valid
+    return response.status_code == 200 and 'status=OK' in response.text and f'otp={otp}' in response.text
+
+def yubikey_public_id(otp):
+    """Public ID (first 12 characters) of a well-formed OTP, or None if malformed"""
+    # The whole OTP, including the public ID, is modhex
+    if not otp or not _MODHEX44.match(otp):
+        return None
+    return otp[:12]
 
 def verify_yubikey_otp(otp):
     """
     Verify a YubiKey OTP using YubiCloud API.
     YubiKey OTP is 44 characters: first 12 are public ID, last 32 are OTP.
+    All YubiCloud servers are queried concurrently and the first OK wins.
     Returns tuple: (is_valid: bool, public_id: str or None)
     """
-    import requests
-    import re
-    
-    if not otp or len(otp) != 44:
-        return False, None
-    
-    # Extract public ID (first 12 characters)
-    public_id = otp[:12]
-    
-    # Validate format (YubiKey public IDs are typically hex/modhex)
-    if not re.match(r'^[cbdefghijklnrtuv]{12}$', public_id):
+    # Validate format and extract the public ID without a network call
+    public_id = yubikey_public_id(otp)
+    if public_id is None:
         return False, None
     
     try:
         # Verify OTP with YubiCloud
-        # Use multiple YubiCloud servers for redundancy
-        servers = [
-            'https://api.yubico.com/wsapi/2.0/verify',
-            'https://api2.yubico.com/wsapi/2.0/verify',
-            'https://api3.yubico.com/wsapi/2.0/verify',
-            'https://api4.yubico.com/wsapi/2.0/verify',
-            'https://api5.yubico.com/wsapi/2.0/verify'
-        ]
-        
-        for server in servers:
-            try:
-                response = requests.get(server, params={'id': '1', 'otp': otp, 'nonce': 'timetrack'}, timeout=3)
-                if response.status_code == 200:
-                    # Check if OTP is valid
-                    if 'status=OK' in response.text and f'otp={otp}' in response.text:
-                        return True, public_id
-            except:
-                continue
+        futures = [_YUBI_POOL.submit(_yubicloud_accepts, server, otp) for server in _YUBI_SERVERS]
+        try:
+            for future in as_completed(futures, timeout=_YUBI_DEADLINE):
+                if future.result():
+                    return True, public_id
+        except FutureTimeoutError:
+            logger.warning("YubiKey verification timed out after %ss", _YUBI_DEADLINE)
+        finally:
+            # Drop requests that have not started yet; running ones finish
+            # in the background
+            for future in futures:
+                future.cancel()
         
         return False, None
     except Exception as e:
         # If verification fails, log but don't expose error
-        print(f"YubiKey verification error: {e}")
+        logger.warning("YubiKey verification error: %s", e)
         return False, None
 
+# Update-pipeline stage that rebuilds yubikey_id_list (the bare public IDs)
+# from yubikey_ids, so stores created before the field existed catch up on
+# their next YubiKey change
+_SYNC_YUBIKEY_ID_LIST = {"$set": {"yubikey_id_list": "$yubikey_ids.yubikey_id"}}
+
 def add_yubikey(store_name, yubikey_id, yubikey_name=None):
     """
     Add an authorized YubiKey to a store.
     yubikey_id should be the 12-character public ID.
     Returns True if successful, False otherwise.
     """
-    stores = get_collection("stores")
-    store = stores.find_one({"name": store_name})
-    if not store:
-        return False
-    
     # Validate YubiKey ID format (12 characters, modhex)
-    import re
-    if not yubikey_id or len(yubikey_id) != 12 or not re.match(r'^[cbdefghijklnrtuv]{12}$', yubikey_id):
+    if not yubikey_id or not _MODHEX12.match(yubikey_id):
         return False
     
-    yubikey_ids = store.get("yubikey_ids", [])
-    # Check if YubiKey already exists
-    if any(key.get("yubikey_id") == yubikey_id for key in yubikey_ids):
-        return True  # Already authorized
-    
-    yubikey_ids.append({
+    stores = get_collection("stores")
+    entry = {
         "yubikey_id": yubikey_id,
         "yubikey_name": yubikey_name or "YubiKey",
         "added_at": datetime.utcnow().isoformat()
-    })
-    
+    }
+    # Atomically append unless this YubiKey is already in the list
     result = stores.update_one(
-        {"name": store_name},
-        {"$set": {"yubikey_ids": yubikey_ids}}
+        {"name": store_name, "yubikey_ids.yubikey_id": {"$ne": yubikey_id}},
+        [
+            {"$set": {"yubikey_ids": {"$concatArrays": [
+                {"$ifNull": ["$yubikey_ids", []]}, [{"$literal": entry}]
+            ]}}},
+            _SYNC_YUBIKEY_ID_LIST
+        ]
     )
-    return result.modified_count > 0
+    _invalidate_yubikey_cache(store_name)
+    _invalidate_stores_cache()
+    if result.modified_count > 0:
+        return True
+    
+    # Nothing matched: either the store is missing or the key is already authorized
+    return stores.count_documents({"name": store_name}, limit=1) > 0
 
 def remove_yubikey(store_name, yubikey_id):
     """
@@ -242,38 +504,88 @@ def remove_yubikey(store_name, yubikey_id):
     Returns True if successful, False otherwise.
     """
     stores = get_collection("stores")
-    store = stores.find_one({"name": store_name})
-    if not store:
-        return False
-    
-    yubikey_ids = store.get("yubikey_ids", [])
-    yubikey_ids = [key for key in yubikey_ids if key.get("yubikey_id") != yubikey_id]
-    
     result = stores.update_one(
-        {"name": store_name},
-        {"$set": {"yubikey_ids": yubikey_ids}}
+        {"name": store_name, "yubikey_ids.yubikey_id": yubikey_id},
+        [
+            {"$set": {"yubikey_ids": {"$filter": {
+                "input": "$yubikey_ids",
+                "cond": {"$ne": ["$$this.yubikey_id", {"$literal": yubikey_id}]}
+            }}}},
+            _SYNC_YUBIKEY_ID_LIST
+        ]
     )
+    _invalidate_yubikey_cache(store_name)
+    _invalidate_stores_cache()
     return result.modified_count > 0
 
-def is_yubikey_authorized(store_name, yubikey_id):
+# store name -> frozenset of authorized YubiKey public IDs. Entries are
+# dropped on local writes; the TTL bounds staleness across worker processes.
+_YUBI_CACHE = TTLCache(maxsize=512, ttl=30)
+_YUBI_CACHE_LOCK = threading.Lock()
+
+def _invalidate_yubikey_cache(*store_names):
+    with _YUBI_CACHE_LOCK:
+        for store_name in store_names:
+            _YUBI_CACHE.pop(store_name, None)
+
+def _store_yubikey_ids(store):
+    """Authorized public IDs of an already-loaded store document, as a set"""
+    ids = store.get("yubikey_id_list")
+    if ids is None:
+        # Stores created before yubikey_id_list existed
+        ids = [entry.get("yubikey_id") for entry in store.get("yubikey_ids", [])]
+    return frozenset(ids)
+
+def is_yubikey_authorized(store_name, yubikey_id, store=None):
     """
     Check if a YubiKey public ID is authorized for a store.
     Returns True if authorized, False otherwise.
     If no YubiKeys are registered, returns False (login blocked).
+    Pass the store document when the caller already has it; its ID set is
+    built once and cached instead of being re-read from the database.
     """
-    stores = get_collection("stores")
-    store = stores.find_one({"name": store_name})
-    if not store:
-        return False
-    
-    yubikey_ids = store.get("yubikey_ids", [])
-    
-    # If no YubiKeys are registered, block all logins
-    if len(yubikey_ids) == 0:
-        return False
-    
-    # Check if YubiKey is in the authorized list
-    return any(key.get("yubikey_id") == yubikey_id for key in yubikey_ids)
+    with _YUBI_CACHE_LOCK:
+        authorized = _YUBI_CACHE.get(store_name)
+    
+    if authorized is None and store is not None:
+        authorized = _store_yubikey_ids(store)
+        with _YUBI_CACHE_LOCK:
+            _YUBI_CACHE[store_name] = authorized
+    elif authorized is None:
+        stores = get_collection("stores")
+        # Only the flat list of IDs is transferred; older stores without
+        # yubikey_id_list fall back to the IDs inside yubikey_ids
+        store = stores.find_one(
+            {"name": store_name},
+            {"_id": 0, "ids": {"$ifNull": ["$yubikey_id_list", "$yubikey_ids.yubikey_id", []]}}
+        )
+        # A missing store caches as an empty set, which blocks every login
+        authorized = frozenset((store or {}).get("ids", []))
+        with _YUBI_CACHE_LOCK:
+            _YUBI_CACHE[store_name] = authorized
+    
+    # If no YubiKeys are registered the set is empty and all logins are blocked.
+    # Compare against every registered ID, without stopping at the first hit,
+    # so timing does not reveal how much of an ID matched.
+    candidate = (yubikey_id or "").encode('utf-8')
+    matches = [hmac.compare_digest(known.encode('utf-8'), candidate) for known in authorized]
+    return any(matches)
+
+# Collections whose documents reference a store by name in store_id
+_STORE_SCOPED_COLLECTIONS = ("inventory", "inventory_history", "eod", "timeclock")
+_IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mongo-io")
+
+def _for_each_store_collection(operation, *args):
+    """
+    Run collection.<operation>(*args) on every store-scoped collection
+    concurrently, so the request waits for the slowest one instead of the sum.
+    """
+    futures = [
+        _IO_POOL.submit(getattr(get_collection(name), operation), *args)
+        for name in _STORE_SCOPED_COLLECTIONS
+    ]
+    for future in futures:
+        future.result()  # re-raise the first failure
 
 def update_store(name, new_name=None, username=None, password=None, total_boxes=None):
     """
@@ -297,27 +609,18 @@ def update_store(name, new_name=None, username=None, password=None, total_boxes=
         return False
     
     result = stores.update_one({"name": name}, {"$set": update_data})
+    _invalidate_yubikey_cache(name, new_name)
+    _invalidate_stores_cache()
     
     # If the store name changed, update all related data that uses store_id
     if new_name and new_name != name:
         old_store_name = name
         new_store_name = new_name
         
-        # Update inventory items
-        inventory = get_collection("inventory")
-        inventory.update_many({"store_id": old_store_name}, {"$set": {"store_id": new_store_name}})
-        
-        # Update inventory history
-        inventory_history = get_collection("inventory_history")
-        inventory_history.update_many({"store_id": old_store_name}, {"$set": {"store_id": new_store_name}})
-        
-        # Update EOD reports
-        eod = get_collection("eod")
-        eod.update_many({"store_id": old_store_name}, {"$set": {"store_id": new_store_name}})
-        
-        # Update timeclock entries
-        timeclock = get_collection("timeclock")
-        timeclock.update_many({"store_id": old_store_name}, {"$set": {"store_id": new_store_name}})
+        # Update inventory items, inventory history, EOD reports and timeclock entries
+        _for_each_store_collection(
+            "update_many", {"store_id": old_store_name}, {"$set": {"store_id": new_store_name}}
+        )
     
     return result.modified_count > 0
 
@@ -338,24 +641,14 @@ def delete_store(name):
     # Delete all related data first
     store_name = name  # Store name is used as store_id
     
-    # Delete inventory items for this store
-    inventory = get_collection("inventory")
-    inventory.delete_many({"store_id": store_name})
-    
-    # Delete inventory history snapshots for this store
-    inventory_history = get_collection("inventory_history")
-    inventory_history.delete_many({"store_id": store_name})
-    
-    # Delete EOD reports for this store
-    eod = get_collection("eod")
-    eod.delete_many({"store_id": store_name})
-    
-    # Delete timeclock entries for this store
-    timeclock = get_collection("timeclock")
-    timeclock.delete_many({"store_id": store_name})
+    # Delete inventory items, inventory history snapshots, EOD reports and
+    # timeclock entries for this store
+    _for_each_store_collection("delete_many", {"store_id": store_name})
     
     # Finally, delete the store itself
     result = stores.delete_one({"name": name})
+    _invalidate_yubikey_cache(name)
+    _invalidate_stores_cache()
     return result.deleted_count > 0
 
 # ---------- EMPLOYEES ----------
@@ -372,30 +665,62 @@ def create_employee(store_id, name, role=None, phone_number=None, hourly_pay=Non
     result = employees.insert_one(doc)
     return str(result.inserted_id)
 
-def get_employees(store_id=None):
+def iter_employees(store_id=None):
+    """Yield employees one at a time straight off the cursor."""
     employees = get_collection("employees")
     query = {"store_id": store_id} if store_id else {}
-    results = list(employees.find(query))
-    # Convert _id to employee_id string for frontend
-    for result in results:
+    # The quantized face descriptors are binary and only used for matching
+    cursor = employees.find(query, {"face_descriptors_q8": 0})
+    for result in cursor.batch_size(STREAM_BATCH_SIZE):
+        # Convert _id to employee_id string for frontend
         if "_id" in result:
-            result["employee_id"] = str(result["_id"])
-            del result["_id"]
-    return results
+            result["employee_id"] = str(result.pop("_id"))
+        yield result
+
+def get_employees(store_id=None):
+    return list(iter_employees(store_id))
 
 def delete_employee(employee_id):
     from bson import ObjectId
     employees = get_collection("employees")
-    if not employee_id:
+    if not employee_id or not ObjectId.is_valid(employee_id):
         return False
     try:
         result = employees.delete_one({"_id": ObjectId(employee_id)})
+        if result.deleted_count > 0:
+            bump_gallery_version()
         return result.deleted_count > 0
-    except (ValueError, TypeError):
-        return False
     except Exception:
         return False
 
+# ---------- FACE GALLERY ----------
+# Last gallery version read, so back-to-back clock events share one read.
+# Bumps in this process refresh it at once; GALLERY_VERSION_TTL bounds how
+# long a bump from another worker goes unnoticed.
+_GALLERY_VERSION_CACHE = TTLCache(maxsize=1, ttl=Config.GALLERY_VERSION_TTL)
+_GALLERY_VERSION_LOCK = threading.Lock()
+
+def get_gallery_version():
+    """Counter that changes whenever registered face data changes."""
+    with _GALLERY_VERSION_LOCK:
+        version = _GALLERY_VERSION_CACHE.get("v")
+    if version is None:
+        doc = get_collection("meta").find_one({"_id": "gallery_version"}, {"v": 1})
+        version = doc["v"] if doc else 0
+        with _GALLERY_VERSION_LOCK:
+            _GALLERY_VERSION_CACHE["v"] = version
+    return version
+
+def bump_gallery_version():
+    """Mark cached face galleries (in every process) as stale."""
+    doc = get_collection("meta").find_one_and_update(
+        {"_id": "gallery_version"}, {"$inc": {"v": 1}},
+        projection={"v": 1}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    with _GALLERY_VERSION_LOCK:
+        # Concurrent bumps can finish out of order; keep the newest
+        _GALLERY_VERSION_CACHE["v"] = max(doc["v"], _GALLERY_VERSION_CACHE.get("v", 0))
+
 # ---------- INVENTORY ----------
 def add_inventory_item(store_id, sku, name, quantity=0):
     inventory = get_collection("inventory")
@@ -409,6 +734,8 @@ def update_inventory_item(store_id, sku=None, item_id=None, quantity=None, name=
     If item_id is provided, it takes precedence over sku.
     """
     from bson import ObjectId
+    if item_id and not ObjectId.is_valid(item_id):
+        return False  # Invalid ObjectId format
     inventory = get_collection("inventory")
     update_data = {}
     if quantity is not None:
@@ -431,10 +758,7 @@ def update_inventory_item(store_id, sku=None, item_id=None, quantity=None, name=
     
     # Build query - prefer item_id if provided
     if item_id:
-        try:
-            query = {"_id": ObjectId(item_id)}
-        except:
-            return False  # Invalid ObjectId format
+        query = {"_id": ObjectId(item_id)}
     elif store_id and sku:
         query = {"store_id": store_id, "sku": sku}
     else:
@@ -448,15 +772,18 @@ def delete_inventory_item(store_id, sku):
     result = inventory.delete_one({"store_id": store_id, "sku": sku})
     return result.deleted_count > 0
 
-def get_inventory(store_id=None):
+def iter_inventory(store_id=None):
+    """Yield inventory items one at a time straight off the cursor."""
     inventory = get_collection("inventory")
     query = {"store_id": store_id} if store_id else {}
-    results = list(inventory.find(query))
-    # Convert _id to string for JSON serialization
-    for result in results:
+    for result in inventory.find(query).batch_size(STREAM_BATCH_SIZE):
+        # Convert _id to string for JSON serialization
         if "_id" in result:
             result["_id"] = str(result["_id"])
-    return results
+        yield result
+
+def get_inventory(store_id=None):
+    return list(iter_inventory(store_id))
 
 # ---------- TIME CLOCK ----------
 def clock_in(employee_id):
@@ -477,6 +804,28 @@ def clock_out(entry_id):
     return result.modified_count > 0
 
 # ---------- EOD REPORT ----------
+def _eod_day_start(report_date):
+    """Midnight of an EOD report_date (datetime or ISO date string), or None."""
+    if isinstance(report_date, datetime):
+        day = report_date
+    else:
+        try:
+            day = datetime.fromisoformat(str(report_date))
+        except ValueError:
+            return None
+    return day.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+def _employees_worked(store_id, report_date):
+    """Sorted names of employees who clocked in at the store on report_date."""
+    day_start = _eod_day_start(report_date)
+    if not store_id or day_start is None:
+        return []
+    names = get_collection("timeclock").distinct("employee_name", {
+        "store_id": store_id,
+        "clock_in": {"$gte": day_start, "$lt": day_start + timedelta(days=1)},
+    })
+    return sorted(name for name in names if name)
+
 def create_eod(store_id, report_date, notes=None, cash_amount=0, credit_amount=0, qpay_amount=0, boxes_count=0, total1=0, submitted_by=None):
     eod = get_collection("eod")
     doc = {
@@ -489,54 +838,46 @@ def create_eod(store_id, report_date, notes=None, cash_amount=0, credit_amount=0
         "boxes_count": boxes_count,
         "total1": total1,
         "submitted_by": submitted_by or "Unknown",
+        # Snapshot who worked that day so listing reports needs no join;
+        # clock-ins recorded after the report is submitted are not included.
+        "employees_worked": _employees_worked(store_id, report_date),
         "created_at": datetime.utcnow(),
     }
     result = eod.insert_one(doc)
     return str(result.inserted_id)
 
-def get_eods(store_id=None):
+def backfill_eod_employees_worked():
+    """Fill employees_worked on EOD reports created before it was stored."""
+    eod = get_collection("eod")
+    updated = 0
+    for doc in eod.find({"employees_worked": {"$exists": False}},
+                        {"store_id": 1, "report_date": 1}):
+        names = _employees_worked(doc.get("store_id"), doc.get("report_date"))
+        eod.update_one({"_id": doc["_id"]}, {"$set": {"employees_worked": names}})
+        updated += 1
+    return updated
+
+# Fields returned by get_eods()
+_EOD_FIELDS = {
+    "_id": 0, "store_id": 1, "report_date": 1, "notes": 1, "cash_amount": 1,
+    "credit_amount": 1, "qpay_amount": 1, "boxes_count": 1, "total1": 1,
+    "submitted_by": 1, "employees_worked": 1, "created_at": 1,
+}
+
+def iter_eods(store_id=None, limit=200):
+    """Yield the newest `limit` EOD reports, optionally for one store."""
     eod = get_collection("eod")
-    timeclock = get_collection("timeclock")
     query = {"store_id": store_id} if store_id else {}
-    results = list(eod.find(query, {"_id": 0}).sort("report_date", -1))
-    
-    # Convert datetime objects to ISO format strings for JSON serialization
-    # and add employee names who worked that day
-    for result in results:
-        if "created_at" in result and isinstance(result["created_at"], datetime):
-            # Ensure timezone info is included - if naive datetime, assume UTC and add 'Z'
-            dt = result["created_at"]
-            if dt.tzinfo is None:
-                # Naive datetime from utcnow() - append 'Z' to indicate UTC
-                result["created_at"] = dt.isoformat() + 'Z'
-            else:
-                result["created_at"] = dt.isoformat()
-        
-        # Get employees who worked on this report date
-        report_date = result.get("report_date")
-        store = result.get("store_id")
-        if report_date and store:
-            # Parse report_date to get start and end of day
-            try:
-                from datetime import datetime as dt, timedelta
-                report_dt = dt.fromisoformat(report_date.replace('Z', '+00:00')) if isinstance(report_date, str) else report_date
-                day_start = report_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                day_end = day_start + timedelta(days=1)
-                
-                # Find all timeclock entries for this store on this date
-                entries = list(timeclock.find({
-                    "store_id": store,
-                    "clock_in": {"$gte": day_start, "$lt": day_end}
-                }))
-                
-                # Extract unique employee names
-                employee_names = list(set([entry.get("employee_name", "Unknown") for entry in entries if entry.get("employee_name")]))
-                employee_names.sort()  # Sort alphabetically
-                result["employees_worked"] = employee_names
-            except Exception as e:
-                print(f"Error getting employees for EOD: {e}")
-                result["employees_worked"] = []
-        else:
-            result["employees_worked"] = []
-    
-    return results
+    cursor = (eod.find(query, _EOD_FIELDS)
+              .sort("report_date", DESCENDING)
+              .limit(limit)
+              .batch_size(STREAM_BATCH_SIZE))
+    # created_at stays a datetime; ojsonify() emits it as ISO 8601 with 'Z'
+    for doc in cursor:
+        # Reports written before employees_worked was stored (see the
+        # backfill-eod-employees command)
+        doc.setdefault("employees_worked", [])
+        yield doc
+
+def get_eods(store_id=None, limit=200):
+    return list(iter_eods(store_id, limit))
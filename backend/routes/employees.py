@@ -1,14 +1,14 @@
 # backend/routes/employees.py
 from flask import Blueprint, request, jsonify
-from ..models import get_employees, create_employee, delete_employee
+from ..models import iter_employees, create_employee, delete_employee
+from ..utils import ojsonify_stream
 
 bp = Blueprint("employees", __name__)
 
 @bp.get("/")
 def list_employees():
     store_id = request.args.get("store_id")
-    employees = get_employees(store_id)
-    return jsonify(employees)
+    return ojsonify_stream(iter_employees(store_id))
 
 @bp.post("/")
 def add_employee():
@@ -1,15 +1,18 @@
 # backend/routes/eod.py
 from flask import Blueprint, request, jsonify
 from datetime import datetime
-from ..models import get_eods, create_eod
+import logging
+from ..models import iter_eods, create_eod
+from ..utils import ojsonify_stream
 
 bp = Blueprint("eod", __name__)
+logger = logging.getLogger(__name__)
 
 @bp.get("/")
 def list_eod():
     store_id = request.args.get("store_id")
-    reports = get_eods(store_id)
-    return jsonify(reports)
+    limit = max(request.args.get("limit", 200, type=int), 1)
+    return ojsonify_stream(iter_eods(store_id, limit=limit))
 
 @bp.post("/")
 def add_eod():
@@ -21,10 +24,11 @@ def add_eod():
     boxes_count = int(data.get("boxes_count", 0) or 0)
     total1 = float(data.get("total1", 0) or 0)
     
-    # Debug logging
-    print(f"EOD Submission received: cash_amount={cash_amount}, credit_amount={credit_amount}, "
-          f"qpay_amount={qpay_amount}, boxes_count={boxes_count}, total1={total1}, "
-          f"notes={data.get('notes', '')[:50]}")
+    # Debug logging (arguments are only formatted when DEBUG is enabled)
+    logger.debug("EOD submission received: cash_amount=%s, credit_amount=%s, "
+                 "qpay_amount=%s, boxes_count=%s, total1=%s, notes=%.50s",
+                 cash_amount, credit_amount, qpay_amount, boxes_count, total1,
+                 data.get("notes") or "")
     
     eod_id = create_eod(
         store_id=data.get("store_id"),
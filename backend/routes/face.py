@@ -3,15 +3,51 @@ from flask import Blueprint, request, jsonify
 from bson import ObjectId
 from datetime import datetime
 from ..services.face_service import (
-    find_best_match, 
-    validate_face_descriptor,
-    compress_image,
-    euclidean_distance
+    parse_face_descriptor,
+    compress_image_async,
+    min_distance,
+    descriptor_fields,
+    quantize_descriptor,
+    get_gallery,
+    match_gallery
 )
-from ..models import get_collection
+from ..models import get_collection, bump_gallery_version, CASE_INSENSITIVE
 
 bp = Blueprint("face", __name__)
 
+# Employee fields the registration handlers read (skips the stored face_image)
+_DESCRIPTOR_PROJECTION = {
+    "name": 1, "face_registered": 1, "face_descriptors": 1,
+    "face_descriptor": 1, "face_descriptors_q8": 1
+}
+
+
+def _append_descriptor(employees, employee, existing_descriptors, face_descriptor, update_data):
+    """
+    Append a face descriptor to an employee in one atomic update, keeping the
+    last 5 and the quantized copies in step. Returns the new descriptor count.
+    """
+    quantized = employee.get("face_descriptors_q8")
+    if (isinstance(employee.get("face_descriptors"), list) and isinstance(quantized, list)
+            and len(quantized) == len(existing_descriptors)):
+        update = {
+            "$push": {
+                "face_descriptors": {"$each": [face_descriptor], "$slice": -5},
+                "face_descriptors_q8": {"$each": [quantize_descriptor(face_descriptor)], "$slice": -5}
+            },
+            "$set": update_data
+        }
+    else:
+        # Old single descriptor format or no quantized copy yet: rewrite both lists
+        descriptors = (existing_descriptors + [face_descriptor])[-5:]
+        update = {"$set": {**descriptor_fields(descriptors), **update_data}}
+    
+    # Remove old single descriptor format if it exists
+    update["$unset"] = {"face_descriptor": ""}
+    employees.update_one({"_id": employee["_id"]}, update)
+    bump_gallery_version()
+    return min(len(existing_descriptors) + 1, 5)
+
 
 @bp.post("/add-appearance")
 def add_face_appearance():
@@ -38,16 +74,17 @@ def add_face_appearance():
         employees = get_collection("employees")
         
         if employee_name:
-            # Search by name (case-insensitive)
-            employee = employees.find_one({"name": {"$regex": f"^{employee_name}$", "$options": "i"}})
+            # Search by name (case-insensitive, served by the collated name index)
+            employee = employees.find_one(
+                {"name": employee_name}, _DESCRIPTOR_PROJECTION, collation=CASE_INSENSITIVE
+            )
             if not employee:
                 return jsonify({"error": f"Employee '{employee_name}' not found. Please check the spelling."}), 404
         elif employee_id:
             # Search by ID
-            try:
-                employee = employees.find_one({"_id": ObjectId(employee_id)})
-            except:
+            if not ObjectId.is_valid(employee_id):
                 return jsonify({"error": "Invalid employee_id format"}), 400
+            employee = employees.find_one({"_id": ObjectId(employee_id)}, _DESCRIPTOR_PROJECTION)
         else:
             return jsonify({"error": "Either employee_name or employee_id is required"}), 400
         
@@ -55,26 +92,18 @@ def add_face_appearance():
             return jsonify({"error": "face_descriptor is required"}), 400
         
         # Validate face descriptor format
-        if not validate_face_descriptor(face_descriptor):
+        query = parse_face_descriptor(face_descriptor)
+        if query is None:
             return jsonify({"error": "Invalid face descriptor format. Must be 128-dimensional array"}), 400
         
-        # Get employee
-        employees = get_collection("employees")
-        try:
-            employee = employees.find_one({"_id": ObjectId(employee_id)})
-        except:
-            return jsonify({"error": "Invalid employee_id format"}), 400
-        
         if not employee:
             return jsonify({"error": "Employee not found"}), 404
         
         if not employee.get('face_registered'):
             return jsonify({"error": "Employee does not have an initial face registration. Please register face first."}), 400
         
-        # Compress face image if provided
-        compressed_image = None
-        if face_image:
-            compressed_image = compress_image(face_image, max_size=400)
+        # Compress face image (if provided) while the descriptors are compared
+        image_future = compress_image_async(face_image, max_size=400)
         
         # Get existing descriptors
         existing_descriptors = []
@@ -84,32 +113,23 @@ def add_face_appearance():
             existing_descriptors = [employee['face_descriptor']]
         
         # Check if this new descriptor is too similar to existing ones (prevent duplicates)
-        min_distance_to_existing = float('inf')
-        for existing_desc in existing_descriptors:
-            distance = euclidean_distance(face_descriptor, existing_desc)
-            if distance < min_distance_to_existing:
-                min_distance_to_existing = distance
+        min_distance_to_existing = min_distance(query, existing_descriptors)
         
         # Only add if it's different enough (distance > 0.3 means it's a different appearance)
         if min_distance_to_existing < 0.3:
+            if image_future:
+                image_future.cancel()
             return jsonify({
                 "success": True,
                 "message": "Face already registered (very similar to existing registration)",
-                "employee_id": employee_id,
+                "employee_id": str(employee["_id"]),
                 "employee_name": employee.get("name"),
                 "total_registrations": len(existing_descriptors)
             }), 200
         
-        # Add new descriptor to the list
-        existing_descriptors.append(face_descriptor)
-        
-        # Limit to last 5 registrations
-        if len(existing_descriptors) > 5:
-            existing_descriptors = existing_descriptors[-5:]
+        compressed_image = image_future.result() if image_future else None
         
-        # Update employee with face descriptors array
         update_data = {
-            "face_descriptors": existing_descriptors,
             "face_registered": True,
             "face_registered_at": datetime.utcnow()
         }
@@ -118,12 +138,9 @@ def add_face_appearance():
         if compressed_image:
             update_data["face_image"] = compressed_image
         
-        # Remove old single descriptor format if it exists
-        unset_data = {"face_descriptor": ""}
-        
-        employees.update_one(
-            {"_id": employee["_id"]},
-            {"$set": update_data, "$unset": unset_data}
+        # Add new descriptor to the list, limited to the last 5 registrations
+        total_registrations = _append_descriptor(
+            employees, employee, existing_descriptors, face_descriptor, update_data
         )
         
         return jsonify({
@@ -131,7 +148,7 @@ def add_face_appearance():
             "message": "New face appearance added successfully",
             "employee_id": str(employee["_id"]),
             "employee_name": employee.get("name"),
-            "total_registrations": len(existing_descriptors)
+            "total_registrations": total_registrations
         }), 200
         
     except Exception as e:
@@ -164,39 +181,42 @@ def register_face():
             return jsonify({"error": "face_descriptor is required"}), 400
         
         # Validate face descriptor format
-        if not validate_face_descriptor(face_descriptor):
+        query = parse_face_descriptor(face_descriptor)
+        if query is None:
             return jsonify({"error": "Invalid face descriptor format. Must be 128-dimensional array"}), 400
         
         # Get employee
-        employees = get_collection("employees")
-        try:
-            employee = employees.find_one({"_id": ObjectId(employee_id)})
-        except:
+        if not ObjectId.is_valid(employee_id):
             return jsonify({"error": "Invalid employee_id format"}), 400
         
+        # Compress face image (if provided) while the employee and gallery are queried
+        image_future = compress_image_async(face_image, max_size=400)
+        
+        employees = get_collection("employees")
+        employee = employees.find_one({"_id": ObjectId(employee_id)}, _DESCRIPTOR_PROJECTION)
+        
         if not employee:
+            if image_future:
+                image_future.cancel()
             return jsonify({"error": "Employee not found"}), 404
         
-        # Check for duplicate face - search all registered employees (only check against other employees)
-        all_registered = list(employees.find({
-            "face_registered": True,
-            "_id": {"$ne": ObjectId(employee_id)}  # Exclude current employee
-        }))
+        # Check for duplicate face - search the cached gallery of all registered
+        # employees (only check against other employees)
+        gallery = get_gallery()
         
-        if all_registered:
+        if gallery is not None:
             # Find if this face matches any existing face from other employees
-            match = find_best_match(face_descriptor, all_registered, threshold=0.6)
+            match = match_gallery(query, gallery, threshold=0.6, exclude_id=employee["_id"])
             if match:
+                if image_future:
+                    image_future.cancel()
                 return jsonify({
                     "error": f"This face is already registered to {match['employee_name']}. Each employee must have a unique face.",
                     "duplicate_employee": match['employee_name'],
                     "confidence": match['confidence']
                 }), 409  # 409 Conflict
         
-        # Compress face image if provided
-        compressed_image = None
-        if face_image:
-            compressed_image = compress_image(face_image, max_size=400)
+        compressed_image = image_future.result() if image_future else None
         
         # Support multiple face descriptors per employee
         # Check if employee already has descriptors
@@ -208,11 +228,7 @@ def register_face():
             existing_descriptors = [employee['face_descriptor']]
         
         # Check if this new descriptor is too similar to existing ones (prevent duplicates)
-        min_distance_to_existing = float('inf')
-        for existing_desc in existing_descriptors:
-            distance = euclidean_distance(face_descriptor, existing_desc)
-            if distance < min_distance_to_existing:
-                min_distance_to_existing = distance
+        min_distance_to_existing = min_distance(query, existing_descriptors)
         
         # Only add if it's different enough (distance > 0.3 means it's a different appearance)
         if min_distance_to_existing < 0.3:
@@ -224,12 +240,7 @@ def register_face():
                 "total_registrations": len(existing_descriptors)
             }), 200
         
-        # Add new descriptor to the list
-        existing_descriptors.append(face_descriptor)
-        
-        # Update employee with face descriptors array
         update_data = {
-            "face_descriptors": existing_descriptors,
             "face_registered": True,
             "face_registered_at": datetime.utcnow()
         }
@@ -237,19 +248,9 @@ def register_face():
         # Update face_image (use latest image, or keep existing if not provided)
         if compressed_image:
             update_data["face_image"] = compressed_image
-        elif "face_image" not in employee:
-            # Keep existing image if no new one provided
-            pass
-        
-        # Remove old single descriptor format if it exists
-        update_data["$unset"] = {"face_descriptor": ""}
-        
-        # Clean update_data for MongoDB update
-        unset_data = update_data.pop("$unset", {})
-        employees.update_one(
-            {"_id": ObjectId(employee_id)},
-            {"$set": update_data, "$unset": unset_data} if unset_data else {"$set": update_data}
-        )
+        
+        # Add new descriptor to the list, limited to the last 5 registrations
+        _append_descriptor(employees, employee, existing_descriptors, face_descriptor, update_data)
         
         return jsonify({
             "success": True,
@@ -285,23 +286,21 @@ def recognize_face():
         # Note: store_id is optional now since employees are not tied to stores
         
         # Validate face descriptor format
-        if not validate_face_descriptor(face_descriptor):
+        query = parse_face_descriptor(face_descriptor)
+        if query is None:
             return jsonify({"error": "Invalid face descriptor format. Must be 128-dimensional array"}), 400
         
         # Get all employees with registered faces (not filtered by store anymore)
-        employees = get_collection("employees")
-        registered_employees = list(employees.find({
-            "face_registered": True
-        }))
+        gallery = get_gallery()
         
-        if not registered_employees:
+        if gallery is None:
             return jsonify({
                 "success": False,
                 "error": "No employees with registered faces found"
             }), 404
         
         # Find best match
-        match = find_best_match(face_descriptor, registered_employees, threshold=0.6)
+        match = match_gallery(query, gallery, threshold=0.6)
         
         if match:
             return jsonify({
@@ -327,13 +326,12 @@ def get_employee_face(employee_id):
     Get employee face registration status.
     """
     try:
-        employees = get_collection("employees")
-        
-        try:
-            employee = employees.find_one({"_id": ObjectId(employee_id)})
-        except:
+        if not ObjectId.is_valid(employee_id):
             return jsonify({"error": "Invalid employee_id format"}), 400
         
+        employees = get_collection("employees")
+        employee = employees.find_one({"_id": ObjectId(employee_id)})
+        
         if not employee:
             return jsonify({"error": "Employee not found"}), 404
         
@@ -1,14 +1,14 @@
 # backend/routes/inventory.py
 from flask import Blueprint, request, jsonify
-from ..models import get_inventory, add_inventory_item, update_inventory_item, delete_inventory_item
+from ..models import iter_inventory, add_inventory_item, update_inventory_item, delete_inventory_item
+from ..utils import ojsonify_stream
 
 bp = Blueprint("inventory", __name__)
 
 @bp.route("/", methods=["GET"])
 def list_inventory():
     store_id = request.args.get("store_id")
-    items = get_inventory(store_id)
-    return jsonify(items)
+    return ojsonify_stream(iter_inventory(store_id))
 
 @bp.route("/", methods=["POST"])
 def add_item():
@@ -48,7 +48,8 @@ def update_item():
             query = {"store_id": store_id, "sku": new_sku}
             if item_id:
                 from bson import ObjectId
-                query["_id"] = {"$ne": ObjectId(item_id)}
+                if ObjectId.is_valid(item_id):
+                    query["_id"] = {"$ne": ObjectId(item_id)}
             existing = inventory.find_one(query)
             if existing:
                 return jsonify({"error": f"SKU '{new_sku}' already exists for this store"}), 409
@@ -1,10 +1,26 @@
 # backend/routes/inventory_history.py
 from flask import Blueprint, request, jsonify
 from datetime import datetime
-from ..models import get_collection
+from bson import ObjectId
+from pymongo import ReturnDocument
+from ..models import get_collection, STREAM_BATCH_SIZE
+from ..utils import ojsonify_stream
 
 bp = Blueprint("inventory_history", __name__)
 
+def _parse_ymd(value):
+    """Midnight of a YYYY-MM-DD date string, or None if missing or malformed"""
+    if not value or len(value) != 10:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return None
+
+def _today_midnight(today_date):
+    """Midnight of the device's local date if given, otherwise of the server's local date"""
+    return _parse_ymd(today_date) or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
 @bp.get("/")
 def list_inventory_history():
     """Get inventory history snapshots for a store"""
@@ -15,20 +31,25 @@ def list_inventory_history():
     
     inventory_history = get_collection("inventory_history")
     
-    # Get all snapshots for this store, sorted by date (newest first)
-    snapshots = list(inventory_history.find(
-        {"store_id": store_id},
-        {"_id": 0}
-    ).sort("snapshot_date", -1))
-    
-    # Convert datetime objects to ISO format strings
-    for snapshot in snapshots:
-        if "snapshot_date" in snapshot and isinstance(snapshot["snapshot_date"], datetime):
-            snapshot["snapshot_date"] = snapshot["snapshot_date"].isoformat()
-        if "created_at" in snapshot and isinstance(snapshot["created_at"], datetime):
-            snapshot["created_at"] = snapshot["created_at"].isoformat()
+    # Get all snapshots for this store, sorted by date (newest first), with
+    # dates formatted as ISO strings server-side. The stored times are naive
+    # server-local times, so no 'Z' suffix is added.
+    snapshots = inventory_history.aggregate([
+        {"$match": {"store_id": store_id}},
+        {"$sort": {"snapshot_date": -1}},
+        {"$project": {"_id": 0}},
+        {"$addFields": {
+            "snapshot_date": {"$dateToString": {
+                "date": "$snapshot_date", "format": "%Y-%m-%dT%H:%M:%S"
+            }},
+            "created_at": {"$dateToString": {
+                "date": "$created_at", "format": "%Y-%m-%dT%H:%M:%S.%L"
+            }}
+        }}
+    ], batchSize=STREAM_BATCH_SIZE)
     
-    return jsonify(snapshots)
+    # Each snapshot embeds the full item list, so encode them one at a time
+    return ojsonify_stream(snapshots)
 
 @bp.post("/snapshot")
 def create_inventory_snapshot():
@@ -42,104 +63,63 @@ def create_inventory_snapshot():
     if not store_id:
         return jsonify({"error": "store_id is required"}), 400
     
-    # Get current inventory for this store
+    # Get current inventory for this store, with item field names normalized
+    # for consistency server-side
     inventory = get_collection("inventory")
-    items = list(inventory.find({"store_id": store_id}, {"_id": 0}))
+    normalized_items = list(inventory.aggregate([
+        {"$match": {"store_id": store_id}},
+        {"$project": {
+            "_id": 0,
+            "sku": {"$ifNull": ["$sku", ""]},
+            "name": {"$ifNull": ["$name", "$item_name", "Unknown"]},
+            "quantity": {"$ifNull": ["$quantity", 0]},
+            "price": {"$ifNull": ["$price", 0]}
+        }}
+    ]))
+    
+    # Today's date from device's local time (not server UTC time); it is the
+    # default snapshot date and the cutoff for editing past days
+    today_dt = _today_midnight(today_date)
     
     # Parse snapshot date - use the date string directly (no timezone conversion)
+    snapshot_dt = today_dt
     if snapshot_date:
         try:
             # If snapshot_date is just YYYY-MM-DD, parse it directly
             if len(snapshot_date) == 10:  # YYYY-MM-DD format
-                date_parts = snapshot_date.split('-')
-                snapshot_dt = datetime(int(date_parts[0]), int(date_parts[1]), int(date_parts[2]), 0, 0, 0)
+                snapshot_dt = datetime.strptime(snapshot_date, "%Y-%m-%d")
             else:
                 snapshot_dt = datetime.fromisoformat(snapshot_date.replace('Z', '+00:00'))
                 # Normalize to midnight
                 snapshot_dt = datetime(snapshot_dt.year, snapshot_dt.month, snapshot_dt.day, 0, 0, 0)
         except Exception as parse_err:
+            # Fallback: use today's date
             print(f"Error parsing snapshot_date '{snapshot_date}': {parse_err}")
-            # Fallback: use today_date if provided, otherwise use current date
-            if today_date and len(today_date) == 10:
-                date_parts = today_date.split('-')
-                snapshot_dt = datetime(int(date_parts[0]), int(date_parts[1]), int(date_parts[2]), 0, 0, 0)
-            else:
-                snapshot_dt = datetime.now()  # Use local server time as fallback
-                snapshot_dt = datetime(snapshot_dt.year, snapshot_dt.month, snapshot_dt.day, 0, 0, 0)
-    else:
-        # Use today_date if provided, otherwise use current date
-        if today_date and len(today_date) == 10:
-            date_parts = today_date.split('-')
-            snapshot_dt = datetime(int(date_parts[0]), int(date_parts[1]), int(date_parts[2]), 0, 0, 0)
-        else:
-            snapshot_dt = datetime.now()  # Use local server time as fallback
-            snapshot_dt = datetime(snapshot_dt.year, snapshot_dt.month, snapshot_dt.day, 0, 0, 0)
-    
-    # Normalize item field names for consistency
-    normalized_items = []
-    for item in items:
-        normalized = {
-            "sku": item.get("sku", ""),
-            "name": item.get("name", item.get("item_name", "Unknown")),
-            "quantity": item.get("quantity", 0),
-            "price": item.get("price", 0)
-        }
-        normalized_items.append(normalized)
     
-    # Create snapshot document
     inventory_history = get_collection("inventory_history")
     
-    # Get today's date from device's local time for comparison
-    # Use today_date from frontend (device's local date), not server UTC time
-    if today_date and len(today_date) == 10:
-        try:
-            date_parts = today_date.split('-')
-            today_dt = datetime(int(date_parts[0]), int(date_parts[1]), int(date_parts[2]), 0, 0, 0)
-        except:
-            # Fallback to server local time
-            today_dt = datetime.now()
-            today_dt = datetime(today_dt.year, today_dt.month, today_dt.day, 0, 0, 0)
-    else:
-        # Fallback to server local time if today_date not provided
-        today_dt = datetime.now()
-        today_dt = datetime(today_dt.year, today_dt.month, today_dt.day, 0, 0, 0)
+    # Only today's snapshot can be created or updated - prevent editing past days
+    if snapshot_dt < today_dt:
+        return jsonify({
+            "error": f"Cannot create or update inventory history for past dates. Snapshot date ({snapshot_dt.date()}) is before today ({today_dt.date()})."
+        }), 403
     
-    # Check if snapshot already exists for this date
-    existing = inventory_history.find_one({
-        "store_id": store_id,
-        "snapshot_date": snapshot_dt
-    })
+    # Create or update the snapshot for this date in one atomic upsert; the
+    # unique (store_id, snapshot_date) index keeps concurrent requests from
+    # inserting two. The pre-generated _id tells us whether it was inserted.
+    now = datetime.now()  # Use local server time
+    new_id = ObjectId()
+    snapshot = inventory_history.find_one_and_update(
+        {"store_id": store_id, "snapshot_date": snapshot_dt},
+        {
+            "$set": {"items": normalized_items, "updated_at": now},
+            "$setOnInsert": {"_id": new_id, "created_at": now}
+        },
+        projection={"_id": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     
-    if existing:
-        # Only allow updating today's snapshot - prevent editing past days
-        if snapshot_dt < today_dt:
-            return jsonify({
-                "error": f"Cannot update inventory history for past dates. Snapshot date ({snapshot_dt.date()}) is before today ({today_dt.date()})."
-            }), 403
-        
-        # Update existing snapshot (only allowed for today)
-        inventory_history.update_one(
-            {"_id": existing["_id"]},
-            {"$set": {
-                "items": normalized_items,
-                "updated_at": datetime.now()  # Use local server time
-            }}
-        )
-        return jsonify({"message": "Snapshot updated", "id": str(existing["_id"])}), 200
-    else:
-        # Prevent creating snapshots for past dates
-        if snapshot_dt < today_dt:
-            return jsonify({
-                "error": f"Cannot create inventory snapshot for past dates. Snapshot date ({snapshot_dt.date()}) is before today ({today_dt.date()})."
-            }), 403
-        
-        # Create new snapshot (only for today or future dates - though future is unlikely)
-        doc = {
-            "store_id": store_id,
-            "snapshot_date": snapshot_dt,
-            "items": normalized_items,
-            "created_at": datetime.now()  # Use local server time
-        }
-        
-        result = inventory_history.insert_one(doc)
-        return jsonify({"message": "Snapshot created", "id": str(result.inserted_id)}), 201
+    if snapshot["_id"] == new_id:
+        return jsonify({"message": "Snapshot created", "id": str(new_id)}), 201
+    return jsonify({"message": "Snapshot updated", "id": str(snapshot["_id"])}), 200
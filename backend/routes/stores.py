@@ -1,58 +1,127 @@
 # backend/routes/stores.py
+import hmac
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, request, jsonify
 from ..models import (
-    get_stores, create_store, delete_store, get_store_by_username, update_store,
-    add_yubikey, remove_yubikey, is_yubikey_authorized, verify_yubikey_otp,
+    get_stores, create_store, delete_store, get_store_by_username, get_store_by_name, update_store,
+    add_yubikey, remove_yubikey, is_yubikey_authorized, verify_yubikey_otp, yubikey_public_id,
     verify_password
 )
 from ..config import Config
+from ..utils import json_body, error_response
 
 bp = Blueprint("stores", __name__)
+logger = logging.getLogger(__name__)
+
+# Internal error details are only sent to clients in development
+_DEVELOPMENT = os.getenv("FLASK_ENV") == "development"
+
+# Runs the bcrypt check and the YubiCloud round-trip of a login side by side
+_LOGIN_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="login")
+
+# Running average of YubiCloud verification time. Logins whose OTP is not
+# sent to YubiCloud (unknown user or unregistered key) wait this long
+# instead, capped so the stand-in wait stays bounded.
+_OTP_TIMING = {"seconds": 0.3}
+_OTP_STAND_IN_MAX = 1.0
+
+def _timed_verify_otp(otp):
+    """verify_yubikey_otp() that also updates the running verification time"""
+    start = time.monotonic()
+    result = verify_yubikey_otp(otp)
+    _OTP_TIMING["seconds"] = 0.8 * _OTP_TIMING["seconds"] + 0.2 * (time.monotonic() - start)
+    return result
+
+def _text_rule(field, label, max_length):
+    """(body field, label, length-check regex, too-long message) for a store text field"""
+    return (
+        field,
+        label,
+        re.compile(r".{1,%d}\Z" % max_length, re.S),
+        f"{label} is too long (max {max_length} characters)",
+    )
+
+_STORE_TEXT_FIELDS = (
+    _text_rule("name", "Store name", 100),
+    _text_rule("username", "Username", 50),
+    _text_rule("password", "Password", 200),
+)
+# edit_store identifies the store by "name"; a rename arrives as "new_name"
+_STORE_UPDATE_FIELDS = (_text_rule("new_name", "Store name", 100),) + _STORE_TEXT_FIELDS[1:]
+
+def _store_validator(text_fields, required):
+    """
+    Build the body validator for one route at import time, with its field
+    table, messages and required flag bound in advance.
+    The validator returns (total_boxes, error); total_boxes is an int, or
+    None when it is optional and absent. Missing optional text fields are
+    skipped.
+    """
+    rules = tuple(
+        (field, f"{label} is required", length_re, too_long)
+        for field, label, length_re, too_long in text_fields
+    )
+    missing_boxes = "Total boxes is required" if required else None
+    
+    def validate(data):
+        get = data.get
+        for field, missing, length_re, too_long in rules:
+            value = get(field)
+            if not value:
+                if value is None and not required:
+                    continue
+                return None, missing
+            if not length_re.match(value):
+                return None, too_long
+        
+        total_boxes = get("total_boxes")
+        if total_boxes is None:
+            return None, missing_boxes
+        # Plain ints and ASCII digit strings skip int() + except; anything
+        # else int() accepts (" 3", 3.0) still works. Booleans are rejected
+        # rather than stored as-is.
+        if isinstance(total_boxes, bool):
+            total_boxes = 0
+        elif isinstance(total_boxes, str) and total_boxes.isascii() and total_boxes.isdecimal():
+            total_boxes = int(total_boxes)
+        elif isinstance(total_boxes, float):
+            total_boxes = int(total_boxes) if total_boxes.is_integer() else 0
+        elif not isinstance(total_boxes, int):
+            try:
+                total_boxes = int(total_boxes)
+            except (ValueError, TypeError):
+                total_boxes = 0
+        if total_boxes < 1:
+            return None, "Total boxes must be a positive integer"
+        return total_boxes, None
+    
+    return validate
+
+_validate_new_store = _store_validator(_STORE_TEXT_FIELDS, required=True)
+_validate_store_update = _store_validator(_STORE_UPDATE_FIELDS, required=False)
 
 @bp.get("/")
 def list_stores():
-    stores = get_stores()
-    # Don't return passwords in the list
-    for store in stores:
-        store.pop("password", None)
-    return jsonify(stores)
+    # Password hashes are projected out in the model layer
+    return jsonify(get_stores())
 
 @bp.post("/")
 def add_store():
     try:
-        data = request.get_json()
+        data = json_body()
         if not data:
-            return jsonify({"error": "Request body is required"}), 400
+            return error_response("Request body is required", 400)
         
-        name = data.get("name")
-        if not name:
-            return jsonify({"error": "Store name is required"}), 400
-        if len(name) > 100:
-            return jsonify({"error": "Store name is too long (max 100 characters)"}), 400
-        
-        username = data.get("username")
-        if not username:
-            return jsonify({"error": "Username is required"}), 400
-        if len(username) > 50:
-            return jsonify({"error": "Username is too long (max 50 characters)"}), 400
-        
-        password = data.get("password")
-        if not password:
-            return jsonify({"error": "Password is required"}), 400
-        if len(password) > 200:
-            return jsonify({"error": "Password is too long (max 200 characters)"}), 400
-        
-        total_boxes = data.get("total_boxes")
-        if total_boxes is None:
-            return jsonify({"error": "Total boxes is required"}), 400
-        
-        # Validate total_boxes is a positive integer
-        try:
-            total_boxes = int(total_boxes)
-            if total_boxes < 1:
-                return jsonify({"error": "Total boxes must be a positive integer"}), 400
-        except (ValueError, TypeError):
-            return jsonify({"error": "Total boxes must be a positive integer"}), 400
+        total_boxes, error = _validate_new_store(data)
+        if error:
+            return error_response(error, 400)
+        name = data["name"]
+        username = data["username"]
+        password = data["password"]
         
         store_id = create_store(name, username, password, total_boxes)
         # Return store info without password
@@ -60,119 +129,133 @@ def add_store():
         return jsonify(store_info), 201
     except Exception as e:
         # Log the error for debugging (server-side only)
-        import traceback
-        import os
         error_msg = str(e)
-        traceback.print_exc()
+        logger.exception("Failed to create store")
         # Don't expose internal error details to client in production
-        if os.getenv("FLASK_ENV") == "development":
+        if _DEVELOPMENT:
             return jsonify({"error": f"Failed to create store: {error_msg}"}), 500
         else:
-            return jsonify({"error": "Failed to create store. Please try again."}), 500
+            return error_response("Failed to create store. Please try again.", 500)
 
 @bp.post("/login")
 def store_login():
-    data = request.get_json()
+    data = json_body()
     username = data.get("username", "").strip()
     password = data.get("password", "")
     yubikey_otp = data.get("yubikey_otp", "").strip()  # YubiKey OTP from client
     
     if not username or not password:
-        return jsonify({"error": "Username and password required"}), 400
+        return error_response("Username and password required", 400)
     
+    # Unknown users and stores without a password still go through
+    # verify_password so every failure takes the same time
     store = get_store_by_username(username)
-    if not store:
-        return jsonify({"error": "Invalid credentials"}), 401
+    stored_password = store.get("password") if store else None
     
-    stored_password = store.get("password")
-    if not stored_password:
-        return jsonify({"error": "Invalid credentials"}), 401
+    # The public ID is the OTP's prefix, so malformed OTPs are rejected
+    # locally without asking YubiCloud
+    public_id = yubikey_public_id(yubikey_otp)
+    key_authorized = (
+        store is not None and public_id is not None
+        and is_yubikey_authorized(store.get("name"), public_id, store)
+    )
+    
+    # bcrypt (CPU) and YubiCloud (network) are independent, so wait for the
+    # slower of the two instead of their sum. The password is always checked.
+    # Only OTPs from keys registered to the store reach YubiCloud, so
+    # unauthenticated requests cannot generate outbound traffic; other
+    # well-formed OTPs wait out the typical YubiCloud time instead, so the
+    # response time does not reveal whether the user or key is known.
+    started = time.monotonic()
+    password_future = _LOGIN_POOL.submit(verify_password, password, stored_password)
+    otp_future = _LOGIN_POOL.submit(_timed_verify_otp, yubikey_otp) if key_authorized else None
+    password_ok = password_future.result()
+    if otp_future:
+        is_valid = otp_future.result()[0]
+    else:
+        is_valid = False
+        if public_id is not None:
+            stand_in = min(_OTP_TIMING["seconds"], _OTP_STAND_IN_MAX)
+            time.sleep(max(0.0, stand_in - (time.monotonic() - started)))
     
-    if verify_password(password, stored_password):
+    if password_ok:
         # Check YubiKey authorization
         yubikey_ids = store.get("yubikey_ids", [])
         if len(yubikey_ids) == 0:
-            return jsonify({
-                "error": "No YubiKeys are registered for this store. Please contact your manager to register a YubiKey first."
-            }), 403
+            return error_response(
+                "No YubiKeys are registered for this store. Please contact your manager to register a YubiKey first.", 403
+            )
         
         if not yubikey_otp:
-            return jsonify({
-                "error": "YubiKey OTP is required. Please touch your YubiKey to generate an OTP."
-            }), 400
+            return error_response(
+                "YubiKey OTP is required. Please touch your YubiKey to generate an OTP.", 400
+            )
         
-        # Verify YubiKey OTP and extract public ID
-        is_valid, public_id = verify_yubikey_otp(yubikey_otp)
-        if not is_valid:
-            return jsonify({
-                "error": "Invalid YubiKey OTP. Please try again or contact your manager."
-            }), 403
+        if public_id is None:
+            return error_response(
+                "Invalid YubiKey OTP. Please try again or contact your manager.", 403
+            )
         
         # Check if this YubiKey is authorized for this store
-        if not is_yubikey_authorized(store.get("name"), public_id):
-            return jsonify({
-                "error": "This YubiKey is not authorized for this store. Please contact your manager to register this YubiKey."
-            }), 403
+        if not key_authorized:
+            return error_response(
+                "This YubiKey is not authorized for this store. Please contact your manager to register this YubiKey.", 403
+            )
+        
+        # Verified with YubiCloud above
+        if not is_valid:
+            return error_response(
+                "Invalid YubiKey OTP. Please try again or contact your manager.", 403
+            )
         
         # Don't return password
         store.pop("password", None)
         return jsonify(store), 200
     else:
-        return jsonify({"error": "Invalid credentials"}), 401
+        return error_response("Invalid credentials", 401)
 
 @bp.put("/")
 def edit_store():
     try:
-        data = request.get_json()
+        data = json_body()
         if not data:
-            return jsonify({"error": "Request body is required"}), 400
+            return error_response("Request body is required", 400)
         
         name = data.get("name")
         if not name:
-            return jsonify({"error": "Store name is required"}), 400
+            return error_response("Store name is required", 400)
         
+        total_boxes, error = _validate_store_update(data)
+        if error:
+            return error_response(error, 400)
         new_name = data.get("new_name")
         username = data.get("username")
         password = data.get("password")
-        total_boxes = data.get("total_boxes")
-        
-        # Validate total_boxes if provided
-        if total_boxes is not None:
-            try:
-                total_boxes = int(total_boxes)
-                if total_boxes < 1:
-                    return jsonify({"error": "Total boxes must be a positive integer"}), 400
-            except (ValueError, TypeError):
-                return jsonify({"error": "Total boxes must be a positive integer"}), 400
         
         success = update_store(name, new_name=new_name, username=username, password=password, total_boxes=total_boxes)
         if success:
             # Return updated store info
-            stores = get_stores()
-            updated_store = next((s for s in stores if s.get("name") == (new_name or name)), None)
+            updated_store = get_store_by_name(new_name or name, {"_id": 0, "password": 0})
             if updated_store:
-                updated_store.pop("password", None)
                 return jsonify(updated_store), 200
             return jsonify({"message": f"Store '{name}' updated successfully"}), 200
         else:
             return jsonify({"error": f"Store '{name}' not found or no changes made"}), 404
     except Exception as e:
-        import traceback
-        import os
         error_msg = str(e)
-        traceback.print_exc()
+        logger.exception("Failed to update store")
         # Don't expose internal error details to client in production
-        if os.getenv("FLASK_ENV") == "development":
+        if _DEVELOPMENT:
             return jsonify({"error": f"Failed to update store: {error_msg}"}), 500
         else:
-            return jsonify({"error": "Failed to update store. Please try again."}), 500
+            return error_response("Failed to update store. Please try again.", 500)
 
 @bp.delete("/")
 def remove_store():
-    data = request.get_json()
+    data = json_body()
     name = data.get("name")
     if not name:
-        return jsonify({"error": "Store name is required"}), 400
+        return error_response("Store name is required", 400)
     
     success = delete_store(name)
     if success:
@@ -183,79 +266,86 @@ def remove_store():
 @bp.post("/manager/login")
 def manager_login():
     """Manager login endpoint - validates credentials server-side"""
-    data = request.get_json()
+    data = json_body()
     username = data.get("username", "").strip()
     password = data.get("password", "")
     
     if not username or not password:
-        return jsonify({"error": "Username and password required"}), 400
+        return error_response("Username and password required", 400)
     
-    # Validate against config (from environment variables in production)
-    if username == Config.MANAGER_USERNAME and password == Config.MANAGER_PASSWORD:
+    # Validate against config (from environment variables in production).
+    # Compare both fields in constant time before combining the results.
+    username_ok = hmac.compare_digest(username.encode('utf-8'), Config.MANAGER_USERNAME.encode('utf-8'))
+    if Config.MANAGER_PASSWORD_BCRYPT:
+        # bcrypt check; successful checks are cached briefly by verify_password
+        password_ok = verify_password(password, Config.MANAGER_PASSWORD_BCRYPT)
+    else:
+        password_ok = hmac.compare_digest(password.encode('utf-8'), Config.MANAGER_PASSWORD.encode('utf-8'))
+    if username_ok & password_ok:
         return jsonify({
             "role": "manager",
             "name": "Manager",
             "username": username
         }), 200
     else:
-        return jsonify({"error": "Invalid credentials"}), 401
+        return error_response("Invalid credentials", 401)
 
 @bp.post("/yubikey/register")
 def register_yubikey():
     """Register a YubiKey for a store (manager only)"""
     # Note: In a production environment, add proper session/authentication check here
     try:
-        data = request.get_json()
+        data = json_body()
         store_name = data.get("store_name")
         yubikey_otp = data.get("yubikey_otp", "").strip()  # OTP to extract public ID
         yubikey_name = data.get("yubikey_name", "YubiKey")
         
         if not store_name or not yubikey_otp:
-            return jsonify({"error": "Store name and YubiKey OTP are required"}), 400
+            return error_response("Store name and YubiKey OTP are required", 400)
         
         # Validate input lengths
         if len(store_name) > 100 or len(yubikey_name) > 200:
-            return jsonify({"error": "Input too long"}), 400
+            return error_response("Input too long", 400)
         
         # Verify OTP and extract public ID
         is_valid, public_id = verify_yubikey_otp(yubikey_otp)
         if not is_valid:
-            return jsonify({"error": "Invalid YubiKey OTP. Please touch your YubiKey to generate a valid OTP."}), 400
+            return error_response("Invalid YubiKey OTP. Please touch your YubiKey to generate a valid OTP.", 400)
         
         if not public_id:
-            return jsonify({"error": "Failed to extract YubiKey ID from OTP"}), 400
+            return error_response("Failed to extract YubiKey ID from OTP", 400)
         
         success = add_yubikey(store_name, public_id, yubikey_name)
         if success:
             return jsonify({"message": "YubiKey registered successfully", "yubikey_id": public_id}), 200
         else:
-            return jsonify({"error": "Failed to register YubiKey or store not found"}), 404
+            return error_response("Failed to register YubiKey or store not found", 404)
     except Exception as e:
-        return jsonify({"error": "Failed to register YubiKey"}), 500
+        return error_response("Failed to register YubiKey", 500)
 
 @bp.delete("/yubikey/remove")
 def remove_yubikey_endpoint():
     """Remove a YubiKey from a store (manager only)"""
     # Note: In a production environment, add proper session/authentication check here
     try:
-        data = request.get_json()
+        data = json_body()
         store_name = data.get("store_name")
         yubikey_id = data.get("yubikey_id")
         
         if not store_name or not yubikey_id:
-            return jsonify({"error": "Store name and YubiKey ID are required"}), 400
+            return error_response("Store name and YubiKey ID are required", 400)
         
         # Validate input lengths and format
         if len(store_name) > 100 or len(yubikey_id) != 12:
-            return jsonify({"error": "Invalid input"}), 400
+            return error_response("Invalid input", 400)
         
         success = remove_yubikey(store_name, yubikey_id)
         if success:
             return jsonify({"message": "YubiKey removed successfully"}), 200
         else:
-            return jsonify({"error": "Failed to remove YubiKey or store not found"}), 404
+            return error_response("Failed to remove YubiKey or store not found", 404)
     except Exception as e:
-        return jsonify({"error": "Failed to remove YubiKey"}), 500
+        return error_response("Failed to remove YubiKey", 500)
 
 @bp.get("/yubikey/list")
 def list_yubikeys():
@@ -263,13 +353,12 @@ def list_yubikeys():
     try:
         store_name = request.args.get("store_name")
         if not store_name:
-            return jsonify({"error": "Store name is required"}), 400
+            return error_response("Store name is required", 400)
         
-        stores = get_stores()
-        store = next((s for s in stores if s.get("name") == store_name), None)
+        store = get_store_by_name(store_name, {"_id": 0, "yubikey_ids": 1})
         
         if not store:
-            return jsonify({"error": "Store not found"}), 404
+            return error_response("Store not found", 404)
         
         yubikey_ids = store.get("yubikey_ids", [])
         return jsonify({"yubikeys": yubikey_ids}), 200
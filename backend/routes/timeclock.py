@@ -1,16 +1,185 @@
 # backend/routes/timeclock.py
+import atexit
+import logging
+import threading
+import time
+from collections import deque
 from flask import Blueprint, request, jsonify
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta
-from ..models import get_collection
+from ..config import Config
+from ..models import get_collection, bump_gallery_version
+from ..utils import ojsonify_stream_object
 from ..services.face_service import (
-    find_best_match,
-    validate_face_descriptor,
-    compress_image,
-    euclidean_distance
+    parse_face_descriptor,
+    compress_image_async,
+    employee_min_distance,
+    descriptor_fields,
+    quantize_descriptor,
+    get_gallery,
+    match_gallery
 )
 
 bp = Blueprint("timeclock", __name__)
+logger = logging.getLogger(__name__)
+
+# Largest descriptor distance accepted as the same person at the clock
+_CLOCK_MATCH_THRESHOLD = 0.6
+
+
+def _split_image_write(image_future):
+    """
+    (image to write with the entry, future to attach afterwards) for a
+    compress_image_async() result. Outside serverless the clock response
+    does not wait for compression; on serverless the instance can be frozen
+    once the response is sent, so the image is waited for and written inline.
+    """
+    if image_future is None:
+        return None, None
+    if Config.SERVERLESS:
+        return image_future.result(), None
+    return None, image_future
+
+
+def _attach_image_later(timeclock, image_future, entry_id, field):
+    """Store the compressed face image on a timeclock entry once compression finishes"""
+    if image_future is None:
+        return
+    
+    def attach(future):
+        try:
+            timeclock.update_one({"_id": entry_id}, {"$set": {field: future.result()}})
+        except Exception:
+            logger.exception("Could not attach %s to timeclock entry %s", field, entry_id)
+    
+    image_future.add_done_callback(attach)
+
+
+# Auto-learned descriptor updates waiting to be written in one bulk_write
+_LEARN_QUEUE = deque()
+_LEARN_PENDING = threading.Event()
+_LEARN_WRITER = None
+_LEARN_WRITER_LOCK = threading.Lock()
+# How long the writer waits for concurrent clock events to join a batch
+_LEARN_BATCH_WINDOW = 0.01
+
+
+def _flush_learned_descriptors():
+    """Write every queued descriptor update in one unordered bulk_write"""
+    updates = []
+    while _LEARN_QUEUE:
+        updates.append(_LEARN_QUEUE.popleft())
+    if not updates:
+        return
+    try:
+        get_collection("employees").bulk_write(updates, ordered=False)
+        bump_gallery_version()
+    except Exception:
+        logger.exception("Could not write %d learned face descriptors", len(updates))
+
+
+def _write_learned_descriptors():
+    """Background loop that flushes queued descriptor updates in batches"""
+    while True:
+        _LEARN_PENDING.wait()
+        time.sleep(_LEARN_BATCH_WINDOW)
+        _LEARN_PENDING.clear()
+        _flush_learned_descriptors()
+
+
+def _queue_learned_descriptor(update):
+    """
+    Queue a descriptor update for the background writer. Learning is best
+    effort, so the clock response does not wait for it to be written.
+    On serverless the instance can be frozen once the response is sent,
+    so the update is written before returning instead.
+    """
+    global _LEARN_WRITER
+    _LEARN_QUEUE.append(update)
+    if Config.SERVERLESS:
+        _flush_learned_descriptors()
+        return
+    
+    if _LEARN_WRITER is None:
+        with _LEARN_WRITER_LOCK:
+            if _LEARN_WRITER is None:
+                _LEARN_WRITER = threading.Thread(
+                    target=_write_learned_descriptors, name="face-learn-writer", daemon=True
+                )
+                _LEARN_WRITER.start()
+                # The daemon thread dies with the process; write what is left
+                atexit.register(_flush_learned_descriptors)
+    _LEARN_PENDING.set()
+
+
+def _learn_descriptor(employee, face_descriptor):
+    """
+    Append an auto-learned descriptor to a gallery employee, keeping the last 5.
+    Employees whose float and quantized lists are in step get an atomic
+    $push, batched with other clock events' updates, so concurrent clocks
+    cannot drop each other's descriptors.
+    """
+    quantized = employee.get("face_descriptors_q8")
+    if isinstance(quantized, list) and employee.get("face_descriptor_count") == len(quantized):
+        _queue_learned_descriptor(UpdateOne(
+            {
+                "_id": employee["_id"],
+                "face_descriptors": {"$type": "array"},
+                "face_descriptors_q8": {"$type": "array"}
+            },
+            {"$push": {
+                "face_descriptors": {"$each": [face_descriptor], "$slice": -5},
+                "face_descriptors_q8": {"$each": [quantize_descriptor(face_descriptor)], "$slice": -5}
+            }}
+        ))
+        return
+    
+    # Old single descriptor format, no quantized copy yet, or lists out of
+    # step: rewrite both lists. The gallery projection only keeps the float
+    # lists for documents without a quantized copy
+    if isinstance(quantized, list):
+        employee = get_collection("employees").find_one(
+            {"_id": employee["_id"]}, {"face_descriptors": 1, "face_descriptor": 1}
+        )
+        if not employee:
+            return
+    
+    existing_descriptors = []
+    if isinstance(employee.get('face_descriptors'), list):
+        existing_descriptors = employee['face_descriptors']
+    elif 'face_descriptor' in employee:
+        existing_descriptors = [employee['face_descriptor']]
+    
+    descriptors = (existing_descriptors + [face_descriptor])[-5:]
+    get_collection("employees").update_one(
+        {"_id": employee["_id"]},
+        {"$set": descriptor_fields(descriptors), "$unset": {"face_descriptor": ""}}
+    )
+    bump_gallery_version()
+
+
+def _recognize(query, no_faces_error):
+    """
+    Match a parsed face descriptor against the cached gallery of every
+    registered employee (one vectorized pass, see match_gallery()).
+    
+    Returns:
+        (match, gallery, None) on success, or (None, None, error response) when
+        no faces are registered or nobody matches
+    """
+    gallery = get_gallery()
+    if gallery is None:
+        return None, None, (jsonify({"success": False, "error": no_faces_error}), 404)
+    
+    match = match_gallery(query, gallery, threshold=_CLOCK_MATCH_THRESHOLD)
+    if not match:
+        return None, None, (jsonify({
+            "success": False,
+            "error": "Face not recognized. Please try again or contact your manager."
+        }), 404)
+    return match, gallery, None
 
 
 @bp.post("/clock-in")
@@ -35,19 +204,19 @@ def clock_out_route():
     data = request.get_json()
     entry_id = data.get("entry_id")
     
-    try:
-        timeclock = get_collection("timeclock")
-        result = timeclock.update_one(
-            {"_id": ObjectId(entry_id)},
-            {"$set": {"clock_out": datetime.utcnow()}}
-        )
-        
-        if result.modified_count > 0:
-            return jsonify({"ok": True})
-        else:
-            return jsonify({"error": "Invalid or already clocked out entry"}), 400
-    except:
+    if not ObjectId.is_valid(entry_id):
         return jsonify({"error": "Invalid entry_id format"}), 400
+    
+    timeclock = get_collection("timeclock")
+    result = timeclock.update_one(
+        {"_id": ObjectId(entry_id)},
+        {"$set": {"clock_out": datetime.utcnow()}}
+    )
+    
+    if result.modified_count > 0:
+        return jsonify({"ok": True})
+    else:
+        return jsonify({"error": "Invalid or already clocked out entry"}), 400
 
 
 @bp.post("/clock-in-face")
@@ -75,116 +244,96 @@ def clock_in_face():
         # Note: store_id is optional now since employees are not tied to stores
         
         # Validate face descriptor
-        if not validate_face_descriptor(face_descriptor):
+        query = parse_face_descriptor(face_descriptor)
+        if query is None:
             return jsonify({"error": "Invalid face descriptor format"}), 400
         
-        # Get all employees with registered faces (not filtered by store anymore)
-        employees = get_collection("employees")
-        registered_employees = list(employees.find({
-            "face_registered": True
-        }))
+        # Compress face image (if provided) while the employee is matched
+        image_future = compress_image_async(face_image, max_size=400)
         
-        if not registered_employees:
-            return jsonify({
-                "success": False,
-                "error": "No employees with registered faces found. Please register your face first."
-            }), 404
-        
-        # Find best match
-        match = find_best_match(face_descriptor, registered_employees, threshold=0.6)
-        
-        if not match:
-            return jsonify({
-                "success": False,
-                "error": "Face not recognized. Please try again or contact your manager."
-            }), 404
+        # Match against all employees with registered faces (not filtered by store anymore)
+        match, gallery, error = _recognize(
+            query, "No employees with registered faces found. Please register your face first."
+        )
+        if error:
+            return error
         
         employee_id = match["employee_id"]
         employee_name = match["employee_name"]
         confidence = match["confidence"]
         
         # Automatically learn/update face descriptor if recognition is successful
-        # This helps adapt to appearance changes without manual re-registration
-        employee_doc = employees.find_one({"_id": ObjectId(employee_id)})
-        
-        if employee_doc:
-            # Get existing descriptors
-            existing_descriptors = []
-            if 'face_descriptors' in employee_doc and isinstance(employee_doc['face_descriptors'], list):
-                existing_descriptors = employee_doc['face_descriptors']
-            elif 'face_descriptor' in employee_doc:
-                existing_descriptors = [employee_doc['face_descriptor']]
-            
-            # Check if this new face is different enough from existing ones
-            min_distance = float('inf')
-            for existing_desc in existing_descriptors:
-                distance = euclidean_distance(face_descriptor, existing_desc)
-                if distance < min_distance:
-                    min_distance = distance
-            
-            # If distance > 0.3, it's a different appearance - add it to learn
-            # Only learn if confidence is high (> 0.7) to avoid learning incorrect faces
-            if min_distance > 0.3 and confidence > 0.7:
-                existing_descriptors.append(face_descriptor)
-                # Limit to last 5 registrations to avoid unlimited growth
-                if len(existing_descriptors) > 5:
-                    existing_descriptors = existing_descriptors[-5:]
-                
-                employees.update_one(
-                    {"_id": ObjectId(employee_id)},
-                    {"$set": {"face_descriptors": existing_descriptors}}
-                )
-        
-        # Check if employee is already clocked in today
+        # This helps adapt to appearance changes without manual re-registration.
+        # Check if this new face is different enough from existing ones,
+        # using the employee's rows of the in-memory gallery
+        distance_to_existing = employee_min_distance(query, gallery, match["gallery_index"])
+        
+        # If distance > 0.3, it's a different appearance - add it to learn
+        # Only learn if confidence is high (> 0.7) to avoid learning incorrect faces
+        if distance_to_existing > 0.3 and confidence > 0.7:
+            _learn_descriptor(match["employee"], face_descriptor)
+        
+        compressed_image, deferred_image = _split_image_write(image_future)
+        
+        # Create the clock-in entry unless one is already open today, in a
+        # single round-trip: the upsert returns the existing open entry (and
+        # writes nothing), or None after inserting ours. Two concurrent upserts
+        # can both miss; the unique (employee_id, clock_in_day) index on open
+        # entries rejects the second insert
         timeclock = get_collection("timeclock")
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        # "Today" is the UTC day of this clock-in, read from the clock once
+        clock_in_time = datetime.utcnow()
+        today_start = clock_in_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        doc = {
+            "_id": ObjectId(),
+            "employee_name": employee_name,
+            "store_id": store_id,
+            "clock_in": clock_in_time,
+            "clock_in_day": today_start,
+            "clock_in_face_image": compressed_image,
+            "clock_in_confidence": confidence
+        }
         
-        existing_entry = timeclock.find_one({
+        open_entry_filter = {
             "employee_id": employee_id,
             "clock_in": {"$gte": today_start},
             "clock_out": None
-        })
+        }
+        try:
+            existing_entry = timeclock.find_one_and_update(
+                open_entry_filter,
+                # employee_id and clock_out come from the filter's equality fields
+                {"$setOnInsert": doc},
+                projection={"clock_in": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            # A concurrent clock-in for this employee inserted first
+            existing_entry = timeclock.find_one(open_entry_filter, {"clock_in": 1}) or {
+                "clock_in": None
+            }
         
+        # Naive UTC datetimes are serialized by the app's JSON provider with
+        # the 'Z' timezone indicator
         if existing_entry:
-            # Ensure UTC timezone indicator is included
-            clock_in_iso = existing_entry["clock_in"].isoformat()
-            if not clock_in_iso.endswith('Z') and existing_entry["clock_in"].tzinfo is None:
-                clock_in_iso += 'Z'
-            
+            if deferred_image:
+                deferred_image.cancel()
             return jsonify({
                 "success": False,
                 "error": f"{employee_name} is already clocked in today.",
                 "employee_name": employee_name,
-                "clock_in_time": clock_in_iso
+                "clock_in_time": existing_entry["clock_in"]
             }), 400
         
-        # Compress face image
-        compressed_image = compress_image(face_image, max_size=400) if face_image else None
-        
-        # Create clock-in entry
-        doc = {
-            "employee_id": employee_id,
-            "employee_name": employee_name,
-            "store_id": store_id,
-            "clock_in": datetime.utcnow(),
-            "clock_out": None,
-            "clock_in_face_image": compressed_image,
-            "clock_in_confidence": confidence
-        }
-        
-        result = timeclock.insert_one(doc)
-        
-        # Ensure UTC timezone indicator is included
-        clock_in_iso = doc["clock_in"].isoformat()
-        if not clock_in_iso.endswith('Z') and doc["clock_in"].tzinfo is None:
-            clock_in_iso += 'Z'
+        _attach_image_later(timeclock, deferred_image, doc["_id"], "clock_in_face_image")
         
         return jsonify({
             "success": True,
-            "entry_id": str(result.inserted_id),
+            "entry_id": str(doc["_id"]),
             "employee_id": employee_id,
             "employee_name": employee_name,
-            "clock_in_time": clock_in_iso,
+            "clock_in_time": doc["clock_in"],
             "confidence": confidence
         }), 201
         
@@ -217,74 +366,58 @@ def clock_out_face():
         # Note: store_id is optional now since employees are not tied to stores
         
         # Validate face descriptor
-        if not validate_face_descriptor(face_descriptor):
+        query = parse_face_descriptor(face_descriptor)
+        if query is None:
             return jsonify({"error": "Invalid face descriptor format"}), 400
         
-        # Get all employees with registered faces (not filtered by store anymore)
-        employees = get_collection("employees")
-        registered_employees = list(employees.find({
-            "face_registered": True
-        }))
+        # Compress face image (if provided) while the employee is matched
+        image_future = compress_image_async(face_image, max_size=400)
         
-        if not registered_employees:
-            return jsonify({
-                "success": False,
-                "error": "No employees with registered faces found."
-            }), 404
-        
-        # Find best match
-        match = find_best_match(face_descriptor, registered_employees, threshold=0.6)
-        
-        if not match:
-            return jsonify({
-                "success": False,
-                "error": "Face not recognized. Please try again or contact your manager."
-            }), 404
+        # Match against all employees with registered faces (not filtered by store anymore)
+        match, gallery, error = _recognize(query, "No employees with registered faces found.")
+        if error:
+            return error
         
         employee_id = match["employee_id"]
         employee_name = match["employee_name"]
         confidence = match["confidence"]
         
         # Automatically learn/update face descriptor if recognition is successful
-        employee_doc = employees.find_one({"_id": ObjectId(employee_id)})
-        
-        if employee_doc:
-            # Get existing descriptors
-            existing_descriptors = []
-            if 'face_descriptors' in employee_doc and isinstance(employee_doc['face_descriptors'], list):
-                existing_descriptors = employee_doc['face_descriptors']
-            elif 'face_descriptor' in employee_doc:
-                existing_descriptors = [employee_doc['face_descriptor']]
-            
-            # Check if this new face is different enough from existing ones
-            min_distance = float('inf')
-            for existing_desc in existing_descriptors:
-                distance = euclidean_distance(face_descriptor, existing_desc)
-                if distance < min_distance:
-                    min_distance = distance
-            
-            # If distance > 0.3, it's a different appearance - add it to learn
-            # Only learn if confidence is high (> 0.7) to avoid learning incorrect faces
-            if min_distance > 0.3 and confidence > 0.7:
-                existing_descriptors.append(face_descriptor)
-                # Limit to last 5 registrations to avoid unlimited growth
-                if len(existing_descriptors) > 5:
-                    existing_descriptors = existing_descriptors[-5:]
-                
-                employees.update_one(
-                    {"_id": ObjectId(employee_id)},
-                    {"$set": {"face_descriptors": existing_descriptors}}
-                )
+        # Check if this new face is different enough from existing ones,
+        # using the employee's rows of the in-memory gallery
+        distance_to_existing = employee_min_distance(query, gallery, match["gallery_index"])
         
-        # Find active clock-in entry for today
-        timeclock = get_collection("timeclock")
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        # If distance > 0.3, it's a different appearance - add it to learn
+        # Only learn if confidence is high (> 0.7) to avoid learning incorrect faces
+        if distance_to_existing > 0.3 and confidence > 0.7:
+            _learn_descriptor(match["employee"], face_descriptor)
         
-        active_entry = timeclock.find_one({
-            "employee_id": employee_id,
-            "clock_in": {"$gte": today_start},
-            "clock_out": None
-        })
+        compressed_image, deferred_image = _split_image_write(image_future)
+        
+        # Close today's open entry in one round-trip; the update pipeline
+        # derives hours_worked from the stored clock_in
+        timeclock = get_collection("timeclock")
+        # "Today" is the UTC day of this clock-out, read from the clock once
+        clock_out_time = datetime.utcnow()
+        today_start = clock_out_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        
+        active_entry = timeclock.find_one_and_update(
+            {
+                "employee_id": employee_id,
+                "clock_in": {"$gte": today_start},
+                "clock_out": None
+            },
+            [{"$set": {
+                "clock_out": clock_out_time,
+                "clock_out_face_image": {"$literal": compressed_image},
+                "clock_out_confidence": confidence,
+                "hours_worked": {"$round": [
+                    {"$divide": [{"$subtract": [clock_out_time, "$clock_in"]}, 3600 * 1000]}, 2
+                ]}
+            }}],
+            projection={"clock_in": 1, "hours_worked": 1},
+            return_document=ReturnDocument.AFTER
+        )
         
         if not active_entry:
             return jsonify({
@@ -293,43 +426,18 @@ def clock_out_face():
                 "employee_name": employee_name
             }), 400
         
-        # Compress face image
-        compressed_image = compress_image(face_image, max_size=400) if face_image else None
-        
-        # Update entry with clock-out time
-        clock_out_time = datetime.utcnow()
-        clock_in_time = active_entry["clock_in"]
-        hours_worked = (clock_out_time - clock_in_time).total_seconds() / 3600
-        
-        update_data = {
-            "clock_out": clock_out_time,
-            "clock_out_face_image": compressed_image,
-            "clock_out_confidence": confidence,
-            "hours_worked": round(hours_worked, 2)
-        }
-        
-        timeclock.update_one(
-            {"_id": active_entry["_id"]},
-            {"$set": update_data}
-        )
-        
-        # Ensure UTC timezone indicator is included
-        clock_in_iso = clock_in_time.isoformat()
-        if not clock_in_iso.endswith('Z') and clock_in_time.tzinfo is None:
-            clock_in_iso += 'Z'
-        
-        clock_out_iso = clock_out_time.isoformat()
-        if not clock_out_iso.endswith('Z') and clock_out_time.tzinfo is None:
-            clock_out_iso += 'Z'
+        _attach_image_later(timeclock, deferred_image, active_entry["_id"], "clock_out_face_image")
         
+        # Naive UTC datetimes are serialized by the app's JSON provider with
+        # the 'Z' timezone indicator
         return jsonify({
             "success": True,
             "entry_id": str(active_entry["_id"]),
             "employee_id": employee_id,
             "employee_name": employee_name,
-            "clock_in_time": clock_in_iso,
-            "clock_out_time": clock_out_iso,
-            "hours_worked": round(hours_worked, 2),
+            "clock_in_time": active_entry["clock_in"],
+            "clock_out_time": clock_out_time,
+            "hours_worked": active_entry["hours_worked"],
             "confidence": confidence
         }), 200
         
@@ -337,6 +445,45 @@ def clock_out_face():
         return jsonify({"error": str(e)}), 500
 
 
+# Entry timestamps are naive UTC; MongoDB formats them as ISO 8601 with 'Z'
+_ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%LZ"
+
+
+# Entries fetched per cursor batch when streaming history responses
+_HISTORY_BATCH_SIZE = 500
+
+
+def _entries_pipeline(match, detailed=True):
+    """
+    Aggregation that returns timeclock entries newest first, already shaped
+    for the API: string ids, ISO timestamps and a derived status.
+    The detailed form adds store_id and the face-match confidences.
+    """
+    fields = {
+        "_id": 0,
+        "entry_id": {"$toString": "$_id"},
+        "employee_id": {"$ifNull": ["$employee_id", None]},
+        "employee_name": {"$ifNull": ["$employee_name", "Unknown"]},
+    }
+    if detailed:
+        fields["store_id"] = {"$ifNull": ["$store_id", None]}
+    fields.update({
+        "clock_in": {"$dateToString": {"format": _ISO_FORMAT, "date": "$clock_in"}},
+        # null (not an empty string) for open entries
+        "clock_out": {"$dateToString": {"format": _ISO_FORMAT, "date": "$clock_out"}},
+        "hours_worked": {"$ifNull": ["$hours_worked", None]},
+        "status": {"$cond": [{"$ifNull": ["$clock_out", False]}, "clocked_out", "clocked_in"]},
+    })
+    if detailed:
+        fields["clock_in_confidence"] = {"$ifNull": ["$clock_in_confidence", None]}
+        fields["clock_out_confidence"] = {"$ifNull": ["$clock_out_confidence", None]}
+    return [
+        {"$match": match},
+        {"$sort": {"clock_in": -1}},
+        {"$project": fields},
+    ]
+
+
 @bp.get("/today")
 def get_today_entries():
     """
@@ -355,41 +502,13 @@ def get_today_entries():
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
         tomorrow_start = today_start + timedelta(days=1)
         
-        entries = list(timeclock.find({
+        formatted_entries = list(timeclock.aggregate(_entries_pipeline({
             "store_id": store_id,
             "clock_in": {
                 "$gte": today_start,
                 "$lt": tomorrow_start
             }
-        }).sort("clock_in", -1))
-        
-        # Format entries for response
-        formatted_entries = []
-        for entry in entries:
-            # Ensure UTC timezone indicator is included
-            clock_in_iso = entry["clock_in"].isoformat()
-            if not clock_in_iso.endswith('Z') and entry["clock_in"].tzinfo is None:
-                clock_in_iso += 'Z'
-            
-            clock_out_iso = None
-            if entry.get("clock_out"):
-                clock_out_iso = entry["clock_out"].isoformat()
-                if not clock_out_iso.endswith('Z') and entry["clock_out"].tzinfo is None:
-                    clock_out_iso += 'Z'
-            
-            formatted_entry = {
-                "entry_id": str(entry["_id"]),
-                "employee_id": entry.get("employee_id"),
-                "employee_name": entry.get("employee_name", "Unknown"),
-                "store_id": entry.get("store_id"),
-                "clock_in": clock_in_iso,
-                "clock_out": clock_out_iso,
-                "hours_worked": entry.get("hours_worked"),
-                "status": "clocked_out" if entry.get("clock_out") else "clocked_in",
-                "clock_in_confidence": entry.get("clock_in_confidence"),
-                "clock_out_confidence": entry.get("clock_out_confidence")
-            }
-            formatted_entries.append(formatted_entry)
+        })))
         
         return jsonify({
             "date": today_start.date().isoformat(),
@@ -421,42 +540,12 @@ def get_history():
         timeclock = get_collection("timeclock")
         start_date = datetime.utcnow() - timedelta(days=days)
         
-        entries = list(timeclock.find({
+        entries = timeclock.aggregate(_entries_pipeline({
             "store_id": store_id,
             "clock_in": {"$gte": start_date}
-        }).sort("clock_in", -1))
-        
-        # Format entries for response
-        formatted_entries = []
-        for entry in entries:
-            # Ensure UTC timezone indicator is included
-            clock_in_iso = entry["clock_in"].isoformat()
-            if not clock_in_iso.endswith('Z') and entry["clock_in"].tzinfo is None:
-                clock_in_iso += 'Z'
-            
-            clock_out_iso = None
-            if entry.get("clock_out"):
-                clock_out_iso = entry["clock_out"].isoformat()
-                if not clock_out_iso.endswith('Z') and entry["clock_out"].tzinfo is None:
-                    clock_out_iso += 'Z'
-            
-            formatted_entry = {
-                "entry_id": str(entry["_id"]),
-                "employee_id": entry.get("employee_id"),
-                "employee_name": entry.get("employee_name", "Unknown"),
-                "clock_in": clock_in_iso,
-                "clock_out": clock_out_iso,
-                "hours_worked": entry.get("hours_worked"),
-                "status": "clocked_out" if entry.get("clock_out") else "clocked_in"
-            }
-            formatted_entries.append(formatted_entry)
+        }, detailed=False), batchSize=_HISTORY_BATCH_SIZE)
         
-        return jsonify({
-            "store_id": store_id,
-            "entries": formatted_entries,
-            "total_count": len(formatted_entries),
-            "days": days
-        }), 200
+        return ojsonify_stream_object({"store_id": store_id}, "entries", entries, tail={"days": days})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -480,45 +569,14 @@ def get_employee_history(employee_id):
         start_date = datetime.utcnow() - timedelta(days=days)
         
         # Find all entries for this employee
-        entries = list(timeclock.find({
+        entries = timeclock.aggregate(_entries_pipeline({
             "employee_id": employee_id,
             "clock_in": {"$gte": start_date}
-        }).sort("clock_in", -1))
-        
-        # Format entries for response
-        formatted_entries = []
-        for entry in entries:
-            # Ensure UTC timezone indicator is included
-            clock_in_iso = entry["clock_in"].isoformat()
-            if not clock_in_iso.endswith('Z') and entry["clock_in"].tzinfo is None:
-                clock_in_iso += 'Z'
-            
-            clock_out_iso = None
-            if entry.get("clock_out"):
-                clock_out_iso = entry["clock_out"].isoformat()
-                if not clock_out_iso.endswith('Z') and entry["clock_out"].tzinfo is None:
-                    clock_out_iso += 'Z'
-            
-            formatted_entry = {
-                "entry_id": str(entry["_id"]),
-                "employee_id": entry.get("employee_id"),
-                "employee_name": entry.get("employee_name", "Unknown"),
-                "store_id": entry.get("store_id"),
-                "clock_in": clock_in_iso,
-                "clock_out": clock_out_iso,
-                "hours_worked": entry.get("hours_worked"),
-                "status": "clocked_out" if entry.get("clock_out") else "clocked_in",
-                "clock_in_confidence": entry.get("clock_in_confidence"),
-                "clock_out_confidence": entry.get("clock_out_confidence")
-            }
-            formatted_entries.append(formatted_entry)
+        }), batchSize=_HISTORY_BATCH_SIZE)
         
-        return jsonify({
-            "employee_id": employee_id,
-            "entries": formatted_entries,
-            "total_count": len(formatted_entries),
-            "days": days
-        }), 200
+        return ojsonify_stream_object(
+            {"employee_id": employee_id}, "entries", entries, tail={"days": days}
+        )
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -4,11 +4,15 @@ Face recognition service using face descriptor comparison.
 This service stores and compares 128-dimensional face descriptors generated by face-api.js
 """
 import numpy as np
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 import base64
+from bson import Binary
 from io import BytesIO
 from PIL import Image
 import cv2
+from ..models import get_collection, get_gallery_version
 
 
 def euclidean_distance(descriptor1: List[float], descriptor2: List[float]) -> float:
@@ -16,9 +20,21 @@ def euclidean_distance(descriptor1: List[float], descriptor2: List[float]) -> fl
     Calculate Euclidean distance between two face descriptors.
     Lower distance means more similar faces.
     """
-    arr1 = np.array(descriptor1)
-    arr2 = np.array(descriptor2)
-    return np.linalg.norm(arr1 - arr2)
+    diff = np.subtract(descriptor1, descriptor2, dtype=np.float32)
+    return float(np.sqrt(diff @ diff))
+
+
+def min_distance(descriptor: List[float], descriptors: List[List[float]]) -> float:
+    """
+    Smallest Euclidean distance between a face descriptor and any of a list
+    of descriptors, computed in one vectorized pass over an (N, 128) array.
+    Returns infinity when the list is empty.
+    """
+    if not descriptors:
+        return float('inf')
+    diff = np.asarray(descriptors, dtype=np.float32) - np.asarray(descriptor, dtype=np.float32)
+    # Compare squared distances; only the smallest needs a square root
+    return float(np.sqrt(np.einsum('ij,ij->i', diff, diff).min()))
 
 
 def compare_faces(known_descriptor: List[float], unknown_descriptor: List[float], 
@@ -39,6 +55,236 @@ def compare_faces(known_descriptor: List[float], unknown_descriptor: List[float]
     return is_match, distance
 
 
+def quantize_descriptor(descriptor: List[float]) -> Dict:
+    """
+    Quantize a face descriptor to 8 bits per value: value ~= z + s * code.
+    The 128 codes are stored as a 128-byte Binary alongside the scale and offset.
+    """
+    values = np.asarray(descriptor, dtype=np.float32)
+    low = float(values.min())
+    scale = (float(values.max()) - low) / 255 or 1.0
+    codes = np.round((values - low) / scale).astype(np.uint8)
+    return {'b': Binary(codes.tobytes()), 's': scale, 'z': low}
+
+
+def descriptor_fields(descriptors: List[List[float]]) -> Dict:
+    """
+    Employee document fields for a list of face descriptors. The float lists
+    stay the source of truth; face_descriptors_q8 is the compact copy the
+    matching gallery is built from, so both must always be written together.
+    """
+    return {
+        'face_descriptors': descriptors,
+        'face_descriptors_q8': [quantize_descriptor(d) for d in descriptors]
+    }
+
+
+def _dequantize(entries: List[Dict]) -> np.ndarray:
+    """Rebuild an (N, 128) float32 matrix from quantize_descriptor() entries."""
+    codes = np.frombuffer(b''.join(entry['b'] for entry in entries), dtype=np.uint8)
+    codes = codes.reshape(len(entries), -1).astype(np.float32)
+    scales = np.array([entry['s'] for entry in entries], dtype=np.float32)
+    offsets = np.array([entry['z'] for entry in entries], dtype=np.float32)
+    return offsets[:, None] + scales[:, None] * codes
+
+
+def _stored_descriptors(employee: Dict) -> List[List[float]]:
+    """
+    Face descriptors stored on an employee document.
+    Supports both single descriptor (old format) and multiple descriptors (new format).
+    """
+    if 'face_descriptors' in employee and isinstance(employee['face_descriptors'], list):
+        return employee['face_descriptors']
+    if 'face_descriptor' in employee:
+        return [employee['face_descriptor']]
+    return []
+
+
+# Projection for gallery queries: only the fields build_gallery() and
+# match_gallery() read. Leaves out face_image, and the float descriptor
+# lists whenever the quantized copy is there to use instead.
+GALLERY_PROJECTION = {
+    'name': 1,
+    'store_id': 1,
+    'role': 1,
+    'face_registered': 1,
+    'face_descriptor': 1,
+    'face_descriptors_q8': 1,
+    'face_descriptors': {'$cond': [
+        {'$isArray': '$face_descriptors_q8'}, '$$REMOVE', '$face_descriptors'
+    ]},
+    # Lets auto-learning check the float and quantized lists are in step
+    # without loading the float lists
+    'face_descriptor_count': {'$cond': [
+        {'$isArray': '$face_descriptors'}, {'$size': '$face_descriptors'}, '$$REMOVE'
+    ]}
+}
+
+
+def build_gallery(employees: List[Dict]) -> Optional[Dict]:
+    """
+    Stack every stored descriptor of the face-registered employees into one
+    (N, 128) float32 matrix so a probe can be compared against all of them at once.
+    Rows keep the order of `employees`.
+    
+    Returns:
+        Dictionary with the matrix, half its squared row norms, the index into
+        `employees` that owns each row, the employees and their ids as
+        strings; None if there are no descriptors
+    """
+    blocks = []
+    owners = []
+    for index, employee in enumerate(employees):
+        if not employee.get('face_registered'):
+            continue
+        # Prefer the quantized copy; documents written before it existed
+        # fall back to the float lists
+        quantized = employee.get('face_descriptors_q8')
+        if quantized:
+            block = _dequantize(quantized)
+        else:
+            descriptors = _stored_descriptors(employee)
+            if not descriptors:
+                continue
+            block = np.asarray(descriptors, dtype=np.float32)
+        blocks.append(block)
+        owners.extend([index] * len(block))
+    
+    if not blocks:
+        return None
+    
+    matrix = np.concatenate(blocks)
+    return {
+        'matrix': matrix,
+        'half_sq_norms': np.einsum('ij,ij->i', matrix, matrix) / 2,
+        'owners': np.asarray(owners),
+        'employees': employees,
+        'employee_ids': [str(employee.get('_id', '')) for employee in employees]
+    }
+
+
+# A match this close is accepted without scanning the rest of the gallery
+STRONG_MATCH_DISTANCE = 0.35
+# Gallery rows compared per matrix-vector product before checking for a strong match
+_MATCH_CHUNK_ROWS = 64
+
+
+def match_gallery(face_descriptor: List[float], gallery: Dict,
+                  threshold: float = 0.6, exclude_id=None) -> Optional[Dict]:
+    """
+    Find the best matching employee in a gallery from build_gallery().
+    
+    Rows are ranked with matrix-vector products using
+    ||a - b||^2 / 2 = ||a||^2 / 2 + ||b||^2 / 2 - a.b
+    where ||a||^2 / 2 is precomputed per row and ||b||^2 / 2 is the same for
+    every row, so only the winning row's distance is completed. The gallery
+    is scanned in chunks (most recently registered employees first when built
+    by get_gallery()) and the scan stops early once a row is within
+    STRONG_MATCH_DISTANCE.
+    
+    Args:
+        exclude_id: Optional employee _id whose descriptors are skipped
+    
+    Returns:
+        Dictionary with employee info and confidence, or None if no match
+    """
+    query = np.asarray(face_descriptor, dtype=np.float32)
+    half_query_sq = float(query @ query) / 2
+    strong_score = STRONG_MATCH_DISTANCE ** 2 / 2 - half_query_sq
+    matrix = gallery['matrix']
+    half_sq_norms = gallery['half_sq_norms']
+    
+    excluded = None
+    if exclude_id is not None:
+        excluded_owners = [index for index, employee in enumerate(gallery['employees'])
+                           if employee.get('_id') == exclude_id]
+        excluded = np.isin(gallery['owners'], excluded_owners)
+    
+    best_row = 0
+    best_score = float('inf')
+    for start in range(0, len(matrix), _MATCH_CHUNK_ROWS):
+        end = start + _MATCH_CHUNK_ROWS
+        scores = half_sq_norms[start:end] - matrix[start:end] @ query
+        if excluded is not None:
+            scores[excluded[start:end]] = np.inf
+        row = int(scores.argmin())
+        if scores[row] < best_score:
+            best_score = float(scores[row])
+            best_row = start + row
+        if best_score < strong_score:
+            break
+    
+    # Reject on the squared distance so a miss never takes the square root
+    sq_distance = 2 * (best_score + half_query_sq)
+    if sq_distance >= threshold * threshold:
+        return None
+    # Rounding can push a near-zero squared distance slightly negative
+    best_distance = float(np.sqrt(max(sq_distance, 0.0)))
+    
+    best_index = int(gallery['owners'][best_row])
+    best_match = gallery['employees'][best_index]
+    
+    # Convert distance to confidence score (0-1, higher is better)
+    # Distance of 0 = confidence 1.0, distance of threshold = confidence 0.0
+    confidence = max(0, 1 - (best_distance / threshold))
+    
+    return {
+        'employee_id': gallery['employee_ids'][best_index],
+        'employee_name': best_match.get('name', 'Unknown'),
+        'store_id': best_match.get('store_id', ''),
+        'role': best_match.get('role', ''),
+        'confidence': round(confidence, 3),
+        'distance': round(best_distance, 3),
+        'gallery_index': best_index,
+        # The matched gallery document itself, so callers need not fetch it again
+        'employee': best_match
+    }
+
+
+def employee_min_distance(face_descriptor: np.ndarray, gallery: Dict, gallery_index: int) -> float:
+    """
+    Smallest distance between a descriptor and the gallery rows of one
+    employee (gallery_index as returned by match_gallery()). Works on the
+    gallery's float32 matrix, so the employee's stored lists are not converted.
+    """
+    rows = gallery['matrix'][gallery['owners'] == gallery_index]
+    if not len(rows):
+        return float('inf')
+    diff = rows - face_descriptor
+    return float(np.sqrt(np.einsum('ij,ij->i', diff, diff).min()))
+
+
+# Gallery built by get_gallery(), reused until the gallery version changes
+_GALLERY_CACHE = {'version': None, 'gallery': None}
+_GALLERY_LOCK = threading.Lock()
+
+
+def get_gallery() -> Optional[Dict]:
+    """
+    Gallery of every face-registered employee, rebuilt only when the gallery
+    version in MongoDB has changed since it was last built.
+    
+    Returns:
+        Gallery from build_gallery(), or None if no descriptors are registered
+    """
+    # Read the version before the employees so a concurrent write can only
+    # make the cached gallery newer than its version, never older
+    version = get_gallery_version()
+    with _GALLERY_LOCK:
+        if _GALLERY_CACHE['version'] == version:
+            return _GALLERY_CACHE['gallery']
+    
+    # Most recently registered first, so match_gallery() tends to stop early
+    employees = list(get_collection("employees").find(
+        {"face_registered": True}, GALLERY_PROJECTION
+    ).sort("face_registered_at", -1))
+    gallery = build_gallery(employees)
+    with _GALLERY_LOCK:
+        _GALLERY_CACHE['version'] = version
+        _GALLERY_CACHE['gallery'] = gallery
+    return gallery
+
+
 def find_best_match(face_descriptor: List[float], employees: List[Dict], 
                     threshold: float = 0.6) -> Optional[Dict]:
     """
@@ -53,72 +299,40 @@ def find_best_match(face_descriptor: List[float], employees: List[Dict],
     Returns:
         Dictionary with employee info and confidence, or None if no match
     """
-    best_match = None
-    best_distance = float('inf')
-    
-    for employee in employees:
-        if not employee.get('face_registered'):
-            continue
-        
-        # Support both single descriptor (old format) and multiple descriptors (new format)
-        stored_descriptors = []
-        if 'face_descriptors' in employee and isinstance(employee['face_descriptors'], list):
-            # New format: array of descriptors
-            stored_descriptors = employee['face_descriptors']
-        elif 'face_descriptor' in employee:
-            # Old format: single descriptor - convert to list
-            stored_descriptors = [employee['face_descriptor']]
-        
-        if not stored_descriptors:
-            continue
-        
-        # Check against all descriptors for this employee, take the best match
-        employee_best_distance = float('inf')
-        for stored_descriptor in stored_descriptors:
-            distance = euclidean_distance(face_descriptor, stored_descriptor)
-            if distance < employee_best_distance:
-                employee_best_distance = distance
-        
-        # If this employee's best match is better than global best, update
-        if employee_best_distance < threshold and employee_best_distance < best_distance:
-            best_distance = employee_best_distance
-            best_match = employee
-    
-    if best_match:
-        # Convert distance to confidence score (0-1, higher is better)
-        # Distance of 0 = confidence 1.0, distance of threshold = confidence 0.0
-        confidence = max(0, 1 - (best_distance / threshold))
-        
-        return {
-            'employee_id': str(best_match.get('_id', '')),
-            'employee_name': best_match.get('name', 'Unknown'),
-            'store_id': best_match.get('store_id', ''),
-            'role': best_match.get('role', ''),
-            'confidence': round(confidence, 3),
-            'distance': round(best_distance, 3)
-        }
-    
-    return None
+    gallery = build_gallery(employees)
+    if gallery is None:
+        return None
+    return match_gallery(face_descriptor, gallery, threshold)
 
 
-def validate_face_descriptor(descriptor: List[float]) -> bool:
+def parse_face_descriptor(descriptor: List[float]) -> Optional[np.ndarray]:
     """
-    Validate that a face descriptor has the correct format.
+    Convert a face descriptor to a float32 array in one C-level pass.
     Face-api.js generates 128-dimensional descriptors.
+    
+    Returns:
+        Array of shape (128,), or None if the descriptor is not a list of
+        128 finite numbers
     """
     if not isinstance(descriptor, (list, tuple)):
-        return False
-    
-    if len(descriptor) != 128:
-        return False
+        return None
     
-    # Check that all values are numbers
     try:
-        for val in descriptor:
-            float(val)
-        return True
+        values = np.asarray(descriptor, dtype=np.float32)
     except (ValueError, TypeError):
-        return False
+        return None
+    
+    if values.shape != (128,) or not np.isfinite(values).all():
+        return None
+    return values
+
+
+def validate_face_descriptor(descriptor: List[float]) -> bool:
+    """
+    Validate that a face descriptor has the correct format.
+    Face-api.js generates 128-dimensional descriptors.
+    """
+    return parse_face_descriptor(descriptor) is not None
 
 
 def decode_base64_image(base64_string: str) -> Optional[np.ndarray]:
@@ -178,6 +392,9 @@ def compress_image(base64_string: str, max_size: int = 500) -> str:
         
         # Convert to PIL Image
         image = Image.open(BytesIO(image_data))
+        # Let the JPEG decoder scale down in the DCT domain (to no less than
+        # max_size) so large captures are not fully decoded; no-op for PNG
+        image.draft('RGB', (max_size, max_size))
         
         # Resize if needed
         if max(image.size) > max_size:
@@ -185,9 +402,10 @@ def compress_image(base64_string: str, max_size: int = 500) -> str:
             new_size = tuple(int(dim * ratio) for dim in image.size)
             image = image.resize(new_size, Image.Resampling.LANCZOS)
         
-        # Convert to JPEG and compress
+        # Convert to JPEG and compress; optimize=True would cost an extra
+        # Huffman pass for a few percent of size on a ~500px image
         buffer = BytesIO()
-        image.convert('RGB').save(buffer, format='JPEG', quality=85, optimize=True)
+        image.convert('RGB').save(buffer, format='JPEG', quality=85, optimize=False)
         
         # Encode back to base64
         compressed_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
@@ -196,3 +414,19 @@ def compress_image(base64_string: str, max_size: int = 500) -> str:
     except Exception as e:
         print(f"Error compressing image: {e}")
         return base64_string  # Return original if compression fails
+
+
+# Image recompression runs on this pool so it overlaps the request's MongoDB calls
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="face-image")
+
+
+def compress_image_async(base64_string: Optional[str], max_size: int = 500) -> Optional[Future]:
+    """
+    Start compress_image() on the image worker pool.
+    
+    Returns:
+        Future resolving to the compressed base64 image, or None if no image was given
+    """
+    if not base64_string:
+        return None
+    return _IMAGE_POOL.submit(compress_image, base64_string, max_size)
@@ -0,0 +1,137 @@
+# backend/utils.py
+import functools
+
+import orjson
+from bson import ObjectId
+from flask import current_app, g, request, stream_with_context
+from flask.json.provider import JSONProvider
+
+# Naive datetimes in MongoDB are UTC; emit them as RFC 3339 with a 'Z' suffix
+_ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(obj):
+    """Serialize types orjson does not handle natively."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify() and get_json() skip
+    the stdlib json module. Datetimes come out as RFC 3339, like ojsonify."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS),
+            mimetype="application/json",
+        )
+
+
+def json_body():
+    """Parsed JSON request body, decoded once per request and reused.
+
+    The raw body is read without Werkzeug caching a copy and handed straight
+    to orjson, so request.get_json() sees an empty body afterwards.
+    Missing or malformed bodies give an empty dict, so routes report their
+    own "field is required" errors instead of Flask's 400/415 pages.
+    """
+    try:
+        return g._json_body
+    except AttributeError:
+        body = None
+        if request.is_json:
+            try:
+                body = orjson.loads(request.get_data(cache=False))
+            except orjson.JSONDecodeError:
+                pass
+        g._json_body = body or {}
+        return g._json_body
+
+
+@functools.lru_cache(maxsize=256)
+def _error_body(message):
+    return orjson.dumps({"error": message})
+
+
+def error_response(message, status):
+    """{"error": message} response whose body is encoded once per message.
+
+    Only for fixed messages; text that varies per request would just churn
+    the cache, so keep using jsonify() for those.
+    """
+    return current_app.response_class(
+        _error_body(message), status=status, mimetype="application/json"
+    )
+
+
+def ojsonify(obj, status=200):
+    """jsonify() replacement that encodes with orjson (C encoder, native datetimes)."""
+    return current_app.response_class(
+        orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS),
+        status=status,
+        mimetype="application/json",
+    )
+
+
+def ojsonify_stream(docs, status=200):
+    """Stream an iterable of documents as a JSON array, encoding one at a time.
+
+    Only the current cursor batch is held in memory instead of the whole
+    result list.
+    """
+    def generate():
+        yield b"["
+        first = True
+        for doc in docs:
+            if not first:
+                yield b","
+            first = False
+            yield orjson.dumps(doc, default=_default, option=_ORJSON_OPTIONS)
+        yield b"]"
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        status=status,
+        mimetype="application/json",
+    )
+
+
+def ojsonify_stream_object(head, key, docs, tail=None, count_key="total_count", status=200):
+    """Stream {**head, key: [docs...], count_key: len(docs), **tail}.
+
+    Like ojsonify_stream(), but for responses that wrap the array in an
+    object. The count comes after the array, since it is only known once
+    the cursor is exhausted.
+    """
+    def generate():
+        # Reopen the encoded head object so the array can be appended to it
+        opening = orjson.dumps(head, default=_default, option=_ORJSON_OPTIONS)[:-1]
+        if head:
+            opening += b","
+        yield opening + orjson.dumps(key) + b":["
+        count = 0
+        for doc in docs:
+            if count:
+                yield b","
+            count += 1
+            yield orjson.dumps(doc, default=_default, option=_ORJSON_OPTIONS)
+        closing = b"]," + orjson.dumps(count_key) + b":" + orjson.dumps(count)
+        if tail:
+            closing += b"," + orjson.dumps(tail, default=_default, option=_ORJSON_OPTIONS)[1:]
+        else:
+            closing += b"}"
+        yield closing
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        status=status,
+        mimetype="application/json",
+    )
@@ -27,9 +27,24 @@ if "%GUNICORN_WORKERS%"=="" (
     set GUNICORN_WORKERS=8
 )
 
-REM Number of threads per worker
+REM Number of threads per worker. Logins spend most of their time waiting on
+REM YubiCloud and bcrypt, both of which release the GIL, so extra threads let
+REM one worker overlap many of them
 if "%GUNICORN_THREADS%"=="" (
-    set GUNICORN_THREADS=2
+    set GUNICORN_THREADS=8
+)
+
+REM Worker class. gthread (default) suits bcrypt-heavy logins; gevent
+REM (pip install gevent) trades that for thousands of concurrent connections
+REM per worker, but bcrypt then blocks every request on the same worker while
+REM it runs
+if "%GUNICORN_WORKER_CLASS%"=="" (
+    set GUNICORN_WORKER_CLASS=gthread
+)
+
+REM Concurrent connections per worker (gevent only)
+if "%GUNICORN_WORKER_CONNECTIONS%"=="" (
+    set GUNICORN_WORKER_CONNECTIONS=1000
 )
 
 REM Bind address and port
@@ -37,15 +52,19 @@ if "%BIND_ADDRESS%"=="" (
     set BIND_ADDRESS=0.0.0.0:5000
 )
 
+REM Pre-compress static assets so WhiteNoise can serve .gz/.br variants
+python -m whitenoise.compress frontend\static
+
 echo Starting TimeTrack with Gunicorn...
 echo Workers: %GUNICORN_WORKERS%
 echo Threads per worker: %GUNICORN_THREADS%
+echo Worker class: %GUNICORN_WORKER_CLASS%
 echo Bind: %BIND_ADDRESS%
 echo MongoDB URI: %MONGO_URI%
 echo.
 
 REM Start Gunicorn
-gunicorn -w %GUNICORN_WORKERS% --threads %GUNICORN_THREADS% -b %BIND_ADDRESS% --timeout 120 --access-logfile - --error-logfile - --log-level info "backend.app:create_app()"
+gunicorn -w %GUNICORN_WORKERS% -k %GUNICORN_WORKER_CLASS% --threads %GUNICORN_THREADS% --worker-connections %GUNICORN_WORKER_CONNECTIONS% -b %BIND_ADDRESS% --timeout 120 --access-logfile - --error-logfile - --log-level info "backend.app:create_app()"
 
 
 
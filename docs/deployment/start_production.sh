@@ -24,15 +24,30 @@ fi
 # Number of workers (adjust based on CPU cores)
 WORKERS=${GUNICORN_WORKERS:-8}
 
-# Number of threads per worker
-THREADS=${GUNICORN_THREADS:-2}
+# Number of threads per worker. Logins spend most of their time waiting on
+# YubiCloud and bcrypt, both of which release the GIL, so extra threads let
+# one worker overlap many of them
+THREADS=${GUNICORN_THREADS:-8}
+
+# Worker class. gthread (default) suits bcrypt-heavy logins; gevent
+# (pip install gevent) trades that for thousands of concurrent connections
+# per worker, but bcrypt then blocks every request on the same worker while
+# it runs
+WORKER_CLASS=${GUNICORN_WORKER_CLASS:-gthread}
+
+# Concurrent connections per worker (gevent only)
+WORKER_CONNECTIONS=${GUNICORN_WORKER_CONNECTIONS:-1000}
 
 # Bind address and port
 BIND_ADDRESS=${BIND_ADDRESS:-"0.0.0.0:5000"}
 
+# Pre-compress static assets so WhiteNoise can serve .gz/.br variants
+python -m whitenoise.compress frontend/static
+
 echo "Starting TimeTrack with Gunicorn..."
 echo "Workers: $WORKERS"
 echo "Threads per worker: $THREADS"
+echo "Worker class: $WORKER_CLASS"
 echo "Bind: $BIND_ADDRESS"
 echo "MongoDB URI: $MONGO_URI"
 echo ""
@@ -40,7 +55,9 @@ echo ""
 # Start Gunicorn
 exec gunicorn \
     -w $WORKERS \
+    -k $WORKER_CLASS \
     --threads $THREADS \
+    --worker-connections $WORKER_CONNECTIONS \
     -b $BIND_ADDRESS \
     --timeout 120 \
     --access-logfile - \